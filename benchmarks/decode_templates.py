@@ -0,0 +1,86 @@
+import os, sys, json, time, random, argparse, tempfile, tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.report.classes import Recruit, TelegramTemplate, TimeRange, Stats
+from src.report.parse import import_raw_template_data, import_template_data
+from src.report.registry import NationRegistry, unique_ids
+
+# Measure what validating exports with decode_template costs, against converting them unchecked after json.load, both interning the nations
+# into a registry as parse_template_folder does. A warm registry already holds every recipient, as when the exports of a category share them.
+
+def write_export(path: str, recipients: int, recruits: int):
+    names = [f"nation_{i}" for i in range(recipients)]
+    data = {
+        "tgid": 12345678, "type": "template", "nation": "testlandia", "category": "benchmark",
+        "createdAt": 1700000000, "generatedAt": 1710000000, "delivered": recipients, "readCount": recipients // 3, "recruitCount": recruits,
+        "recipients": names,
+        "recruits": [{"name": name, "cte": random.random() < 0.1, "timestamp": 1700000000 + i} for i, name in enumerate(random.sample(names, recruits))],
+    }
+
+    with open(path, "w") as f:
+        json.dump(data, f, indent="\t")
+
+def json_load_template(path: str, registry: NationRegistry) -> TelegramTemplate:
+    tgdata = import_raw_template_data(path)
+
+    template = TelegramTemplate()
+    template.tgid = tgdata["tgid"]
+    template.type = tgdata["type"]
+    template.nation = tgdata["nation"]
+    template.category = tgdata.get("category", "Uncategorized")
+    template.timeRange = TimeRange(tgdata["createdAt"], tgdata["generatedAt"])
+    template.stats = Stats(tgdata["delivered"], tgdata.get("readCount", 0), tgdata["recruitCount"])
+    template.recipients = unique_ids(registry.intern_all(tgdata["recipients"]))
+    template.recruits = {}
+    for recruit in tgdata["recruits"]:
+        name = registry.canonical(recruit["name"])
+        template.recruits[name] = Recruit(recruit["cte"], recruit["timestamp"], name)
+
+    return template
+
+def create_registry(recipients: int, warm: bool) -> NationRegistry:
+    registry = NationRegistry()
+    if warm:
+        registry.intern_all(f"nation_{i}" for i in range(recipients))
+    return registry
+
+# The template is kept until the measurement ends, like the parsed templates of a run, so that its memory is part of the peak.
+def measure(function, path: str, recipients: int, warm: bool, repeat: int) -> dict:
+    times = []
+    for _ in range(repeat):
+        registry = create_registry(recipients, warm)
+        start = time.perf_counter()
+        function(path, registry)
+        times.append(time.perf_counter() - start)
+
+    registry = create_registry(recipients, warm)
+    tracemalloc.start()
+    template = function(path, registry)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"seconds": min(times), "peak_bytes": peak}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the telegram template decoder")
+    parser.add_argument("--recipients", default=200000, type=int)
+    parser.add_argument("--recruits", default=5000, type=int)
+    parser.add_argument("--repeat", default=3, type=int)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "export.json")
+        write_export(path, args.recipients, args.recruits)
+
+        results = {"file_bytes": os.path.getsize(path)}
+        for registry in ["fresh", "warm"]:
+            results[registry] = {
+                "json_load": measure(json_load_template, path, args.recipients, registry == "warm", args.repeat),
+                "decode_template": measure(import_template_data, path, args.recipients, registry == "warm", args.repeat),
+            }
+
+    print(json.dumps(results, indent=4))
+
+if __name__ == "__main__":
+    main()
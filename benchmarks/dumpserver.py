@@ -0,0 +1,89 @@
+import os, sys, hashlib, argparse, email.utils
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the NationStates dump server, serving a fixture dump (e.g. one written by generate.py) with the ETag,
+# Last-Modified, HEAD, conditional request and Range support that genreport relies on. Point genreport at it with --dump-url:
+#
+#   python benchmarks/dumpserver.py data/nations.xml.gz --port 8000
+#   python genreport.py -r --dump-url http://localhost:8000/nations.xml.gz ...
+#
+# With --cut-after, full responses are cut off after that many bytes, to test resuming interrupted downloads.
+
+def file_etag(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return f'"{digest.hexdigest()[:32]}"'
+
+class DumpHandler(BaseHTTPRequestHandler):
+    path_on_disk: str
+    cut_after: int | None
+
+    def do_GET(self):
+        self.respond(body=True)
+
+    def do_HEAD(self):
+        self.respond(body=False)
+
+    def respond(self, body: bool):
+        size = os.path.getsize(self.path_on_disk)
+        etag = file_etag(self.path_on_disk)
+        last_modified = email.utils.formatdate(os.path.getmtime(self.path_on_disk), usegmt=True)
+
+        if self.headers.get("If-None-Match") == etag or (not self.headers.get("If-None-Match") and self.headers.get("If-Modified-Since") == last_modified):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        start = 0
+        ranged = self.headers.get("Range", "")
+        if ranged.startswith("bytes=") and ranged.endswith("-") and self.headers.get("If-Range") in (etag, last_modified):
+            start = int(ranged[len("bytes="):-1])
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.end_headers()
+                return
+
+        self.send_response(206 if start else 200)
+        self.send_header("Content-Type", "application/gzip")
+        self.send_header("Content-Length", str(size - start))
+        if start:
+            self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        if not body:
+            return
+
+        remaining = size - start
+        if self.cut_after is not None and not start:
+            remaining = min(remaining, self.cut_after)
+
+        with open(self.path_on_disk, "rb") as f:
+            f.seek(start)
+            while remaining > 0:
+                chunk = f.read(min(remaining, 1024 * 1024))
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+        self.close_connection = True
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fixture data dump like the NationStates dump server")
+    parser.add_argument("dump", help="The nations.xml.gz file to serve, at any path")
+    parser.add_argument("--port", default=8000, type=int)
+    parser.add_argument("--cut-after", type=int, help="Cut full (non-resumed) responses off after this many bytes")
+    args = parser.parse_args()
+
+    DumpHandler.path_on_disk = args.dump
+    DumpHandler.cut_after = args.cut_after
+
+    print(f"Serving {args.dump} on port {args.port}", file=sys.stderr)
+    ThreadingHTTPServer(("", args.port), DumpHandler).serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import os, sys, gzip, json, time, random, argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.report.filters import normalizeNationName
+
+# Generators of synthetic inputs for the report pipeline: a nations.xml.gz data dump and a folder of telegram exports,
+# as produced by the NationStates dump and masstgexport.user.js.
+
+# Region the synthetic campaign recruits for.
+REGION = "Benchmark Region"
+
+DAY = 60 * 60 * 24
+
+REGIONS = [REGION, "The Pacific", "The North Pacific", "The East Pacific", "The South Pacific", "The West Pacific", "The Rejected Realms",
+    "Lazarus", "Osiris", "Balder", "Europeia", "10000 Islands"] + [f"Region {i}" for i in range(2000)]
+
+# Nations are founded one after the other, the newest last, like in the real dump (which is sorted by founding order).
+def nation_name(i: int) -> str:
+    return f"Nation {i}" if i % 4 else f"nation_{i}_puppet"
+
+def write_dump(path: str, nations: int, now: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    names = []
+
+    with gzip.open(path, "wt", encoding="utf-8", compresslevel=1) as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<NATIONS api_version="12">\n')
+
+        for i in range(nations):
+            name = nation_name(i)
+            names.append(normalizeNationName(name))
+
+            # Feeder regions and the recruiting region hold most nations, while a long tail of small regions holds the rest.
+            roll = rng.random()
+            if roll < 0.05:
+                region = REGION
+            elif roll < 0.6:
+                region = REGIONS[1 + int(rng.random() * 11)]
+            else:
+                region = rng.choice(REGIONS[12:])
+
+            wa = "WA Member" if rng.random() < 0.15 else "Non-member"
+            lastlogin = now - int(rng.expovariate(1 / (20 * DAY)))
+
+            f.write(f"<NATION>\n<NAME>{name}</NAME>\n<TYPE>Republic</TYPE>\n<FULLNAME>The Republic of {name}</FULLNAME>\n"
+                f"<MOTTO>Peace &amp; Prosperity</MOTTO>\n<UNSTATUS>{wa}</UNSTATUS>\n<ENDORSEMENTS></ENDORSEMENTS>\n<REGION>{region}</REGION>\n"
+                f"<POPULATION>{rng.randint(5, 20000)}</POPULATION>\n<LASTLOGIN>{lastlogin}</LASTLOGIN>\n<FACTBOOKS>0</FACTBOOKS>\n</NATION>\n")
+
+        f.write("</NATIONS>\n")
+
+    return names
+
+# Write the given number of telegram exports into folder. Recruitment telegrams go to recently founded nations, so recipients are drawn from the newest
+# nations of the dump, overlapping between templates; a few of them have ceased to exist since. About 4% of recipients are recruited.
+def write_exports(folder: str, names: list[str], exports: int, recipients: int, now: int, seed: int = 0, categories: int = 4):
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+
+    newest = names[-max(1, len(names) // 5):]
+    ceased = [f"ceased_nation_{i}" for i in range(max(1, recipients // 20))]
+    senders = [names[i] for i in range(min(len(names), 40))]
+
+    for i in range(exports):
+        count = max(1, int(rng.lognormvariate(0, 0.5) * recipients))
+        template_recipients = rng.sample(newest, min(count, len(newest))) + rng.sample(ceased, min(len(ceased), count // 50))
+        recruits = rng.sample(template_recipients, max(1, len(template_recipients) // 25))
+
+        data = {
+            "tgid": 30000000 + i, "type": rng.choice(["api", "template", "generic"]), "nation": rng.choice(senders),
+            "createdAt": now - rng.randint(60, 400) * DAY, "generatedAt": now - rng.randint(0, 30) * DAY,
+            "delivered": len(template_recipients), "readCount": len(template_recipients) // 3, "recruitCount": len(recruits),
+            "recipients": template_recipients,
+            "recruits": [{"name": name, "cte": name.startswith("ceased_"), "timestamp": now - rng.randint(0, 365) * DAY} for name in recruits],
+        }
+
+        category = i % (categories + 1)
+        if category < categories:
+            data["category"] = f"category_{category}"
+
+        with open(os.path.join(folder, f"{data['tgid']}.json"), "w") as f:
+            json.dump(data, f, indent="\t")
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic data dump and telegram exports")
+    parser.add_argument("output", help="Folder to write nations.xml.gz and telegrams/ into")
+    parser.add_argument("--nations", default=100000, type=int)
+    parser.add_argument("--exports", default=40, type=int)
+    parser.add_argument("--recipients", default=5000, type=int, help="Typical number of recipients per export")
+    parser.add_argument("--seed", default=0, type=int)
+    args = parser.parse_args()
+
+    now = int(time.time())
+    os.makedirs(args.output, exist_ok=True)
+    names = write_dump(os.path.join(args.output, "nations.xml.gz"), args.nations, now, args.seed)
+    write_exports(os.path.join(args.output, "telegrams"), names, args.exports, args.recipients, now, args.seed)
+
+if __name__ == "__main__":
+    main()
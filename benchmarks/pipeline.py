@@ -0,0 +1,158 @@
+import os, sys, json, time, sqlite3, argparse, platform, subprocess, tempfile
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+
+from src.report.datadump import parse_nation_data, insert_nation_data, set_bulk_load_pragmas, reset_bulk_load_pragmas, create_dump_schema, create_dump_indexes
+from src.report.parse import parse_template_folder
+from src.report.analytics import generate_analytics
+from src.report.cohorts import generate_cohorts
+from src.report.backend import SQLiteBackend
+from src.report.classes import Analytics, merge_into
+from src.report.filters import normalizeNationName
+from src.report.registry import NationRegistry
+from src.report.reportfile import ReportWriter
+from src.report.view import resolve_canon_names, build_index_view
+from src.report.render import render_report
+from benchmarks.generate import REGION, write_dump, write_exports
+
+# Benchmark of every stage of the report pipeline on synthetic data, one run per dump size. Results are written as JSON, so that runs
+# of different commits can be compared:
+#
+#   python benchmarks/pipeline.py --nations 100000,500000,2000000 --output results.json
+
+def commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPOSITORY, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Stages:
+    def __init__(self):
+        self.results: dict[str, dict] = {}
+
+    # Run function, recording its wall time and the number of items it returns (or len() of its result).
+    def run(self, name: str, function, count=len):
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+
+        self.results[name] = {"seconds": round(seconds, 4), "items": count(result)}
+        print(f"{name}: {seconds:.3f}s")
+        return result
+
+def run_pipeline(folder: str, nations: int, exports: int, recipients: int, seed: int) -> dict:
+    now = int(time.time())
+
+    dump = os.path.join(folder, "nations.xml.gz")
+    telegram_folder = os.path.join(folder, "telegrams")
+    names = write_dump(dump, nations, now, seed)
+    write_exports(telegram_folder, names, exports, recipients, now, seed)
+    del names
+
+    stages = Stages()
+
+    rows = stages.run("dump_parse", lambda: list(parse_nation_data(dump)))
+
+    con = sqlite3.connect(os.path.join(folder, "nations.db"))
+    cursor = con.cursor()
+
+    def build_database():
+        set_bulk_load_pragmas(cursor)
+        create_dump_schema(cursor)
+        count = insert_nation_data(cursor, rows)
+        create_dump_indexes(cursor)
+        con.commit()
+        reset_bulk_load_pragmas(cursor)
+        cursor.execute("ANALYZE")
+        return count
+
+    stages.run("database_build", build_database, count=lambda count: count)
+    del rows
+
+    registry = NationRegistry()
+    telegrams = stages.run("template_parse", lambda: parse_template_folder(telegram_folder, registry, False),
+        count=lambda telegrams: sum(len(telegram.templates) for telegram in telegrams.values()))
+
+    backend = SQLiteBackend(con.cursor())
+    region = normalizeNationName(REGION)
+
+    cohorts = stages.run("cohorts", lambda: generate_cohorts(backend, list(telegrams.values()), region),
+        count=lambda cohorts: sum(sum(category.recruits) for category in cohorts))
+
+    def analyse():
+        for telegram, category_cohorts in zip(telegrams.values(), cohorts):
+            telegram.analytics = generate_analytics(backend, telegram, registry, region)
+            telegram.analytics.cohorts = category_cohorts
+        return telegrams
+
+    stages.run("analytics", analyse, count=lambda telegrams: sum(len(telegram.recipients) for telegram in telegrams.values()))
+
+    analytics = Analytics.empty()
+    methods, nations_stats = {}, {}
+    for telegram in telegrams.values():
+        analytics.merge(telegram.analytics)
+        merge_into(methods, telegram.methods)
+        merge_into(nations_stats, telegram.nations)
+
+    canon_names = resolve_canon_names(backend, telegrams, nations_stats)
+
+    def write_report():
+        writer = ReportWriter(os.path.join(folder, "report.mlr"), registry)
+        for telegram in telegrams.values():
+            writer.write_telegram(telegram)
+        writer.close(analytics, methods, nations_stats, {"canon_names": canon_names})
+        return os.path.getsize(os.path.join(folder, "report.mlr"))
+
+    stages.run("report_write", write_report, count=lambda size: size)
+
+    def write_json():
+        from genreport import MoonlarkEncoder
+        path = os.path.join(folder, "report.json")
+        with open(path, "w") as output:
+            json.dump({"methods": methods, "nations": nations_stats, "analytics": analytics, "telegrams": telegrams, "canon_names": canon_names},
+                fp=output, indent=4, cls=MoonlarkEncoder, registry=registry)
+        return os.path.getsize(path)
+
+    stages.run("json_write", write_json, count=lambda size: size)
+
+    def render():
+        output = os.path.join(folder, "html")
+        os.makedirs(output, exist_ok=True)
+        render_report(output, list(telegrams.values()), canon_names, build_index_view(analytics, methods, nations_stats, telegrams, canon_names))
+        return len(telegrams) + 1
+
+    stages.run("html_render", render, count=lambda pages: pages)
+
+    con.close()
+
+    return {"nations": nations, "exports": exports, "recipients": recipients, "seed": seed, "stages": stages.results}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every stage of the report pipeline on synthetic data")
+    parser.add_argument("--nations", default="100000", help="Comma-separated numbers of nations in the synthetic dump, one run each. Default: 100000.")
+    parser.add_argument("--exports", default=40, type=int, help="Number of telegram exports. Default: 40.")
+    parser.add_argument("--recipients", default=5000, type=int, help="Typical number of recipients per export. Default: 5000.")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--output", help="File to write the results to, as JSON. By default, they are printed.")
+    args = parser.parse_args()
+
+    # Templates are looked up relative to the working directory.
+    os.chdir(REPOSITORY)
+
+    runs = []
+    for nations in [int(n) for n in args.nations.split(",")]:
+        print(f"Benchmarking {nations} nations")
+        with tempfile.TemporaryDirectory() as folder:
+            runs.append(run_pipeline(folder, nations, args.exports, args.recipients, args.seed))
+
+    results = {"commit": commit(), "python": platform.python_version(), "platform": platform.platform(), "runs": runs}
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=4)
+    else:
+        print(json.dumps(results, indent=4))
+
+if __name__ == "__main__":
+    main()
@@ -1,124 +1,320 @@
-import jinja2, os, json, argparse
-from src.report.datadump import generate_database
-from src.report.parse import parse_template_folder
-from src.report.filters import renderDate, items, sortByHighest, sortStatsByHighest, sortTop, sortStatsTop, methodName, displayNumberWithCommas
-from src.report.analytics import generate_analytics, canonName
-from src.report.classes import Analytics, accumulate, Stats, Telegram
+import os, json, shutil, argparse
+from contextlib import ExitStack
+import numpy as np
+from src.report.history import NationHistory, RETENTION_DAYS
+from src.report.view import resolve_canon_names, build_index_view, build_comparison_view
+from src.report.render import render_report, render_comparison
+from src.report.profile import Profiler
+from src.report.classes import Analytics, merge_into, Stats, Telegram, ACTIVITY_THRESHOLDS
+from src.report.registry import NationRegistry
+from src.report.reportfile import REPORT_FILE, ReportReader, ReportWriter, is_report_file, write_report
 
+# The data dump, template parsing and analytics modules (and requests with them) are only imported when generating a new report,
+# so that rendering an existing one with --input starts quickly and doesn't need nations.db.
+
+# Arrays in the report are always recipient nation IDs, which are written out as nation names resolved with the registry.
 class MoonlarkEncoder(json.JSONEncoder):
+    def __init__(self, *args, registry: NationRegistry, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.registry = registry
+
     def default(self, o):
         try:
             return super().default(o)
         except TypeError:
             if type(o) == list:
                 return o
+            if isinstance(o, np.ndarray):
+                return self.registry.names_of(o)
             return o.__dict__
         
 def main():
     parser = argparse.ArgumentParser(prog="genreport", description="Moonlark recruitment report generator")
     parser.add_argument("-n", "--nation-name", default="", help="Main nation of the player using this script")
     parser.add_argument("-r", "--regenerate", action='store_true', help="Whether to re-download the data dump or use the existing one")
+    parser.add_argument("-u", "--refresh", action='store_true', help="Download a new data dump, but only apply the nations that changed to the existing database instead of rebuilding it.")
+    parser.add_argument("-s", "--stream", action='store_true', help="When re-downloading the data dump, parse it and insert it into the database while it is being downloaded, without saving it to disk first.")
+    parser.add_argument("-p", "--parse-jobs", default=1, type=int, help="The number of processes to use to parse a re-downloaded data dump. Ignored with --stream. Default: 1.")
+    parser.add_argument("--dump-url", default=None, help="Download the data dump from this URL instead of from NationStates, e.g. a mirror or a local test server.")
+    parser.add_argument("-m", "--memory", action='store_true', help="Keep the data dump database in memory instead of querying nations.db on disk.")
+    parser.add_argument("--save-memory", action='store_true', help="With --memory, also save a newly downloaded data dump database to nations.db so that it can be reused later.")
+    parser.add_argument("-b", "--backend", choices=["sqlite", "snapshot"], default="sqlite", help="Where to look up nation data during analysis: the nations.db database, or a memory-mapped columnar snapshot of it (nations.snap, rebuilt automatically when outdated). Default: sqlite.")
     parser.add_argument("-a", "--activity-threshold", default=7, type=int, help="The number of days to use as the activity threshold for 'faithful players'. Default: 1 week (7 days).")
-    parser.add_argument("--region", required=True, help="The region to generate statistics for.")
+    parser.add_argument("--activity-thresholds", default=ACTIVITY_THRESHOLDS, type=lambda days: [int(day) for day in days.split(",")], help="Comma-separated numbers of days at which to also count faithful players, to compare activity thresholds in a single report. Default: 1,3,7,14,30.")
+    parser.add_argument("--cohort-bucket", choices=["day", "week"], default="week", help="The time period to group recruits by in the charts of recruitment over time. Default: week.")
+    parser.add_argument("--history", help="If provided, record the data dump in this history database (e.g. history.db) and use all the dumps recorded there to measure how many recruits stayed in the region over time.")
+    parser.add_argument("--retention-days", default=RETENTION_DAYS, type=lambda days: [int(day) for day in days.split(",")], help="Comma-separated numbers of days after recruitment at which to measure retention with --history. Default: 1,7,30,90.")
+    parser.add_argument("-j", "--jobs", default=1, type=int, help="The number of processes to use to generate the analytics of each template category, and to render their pages, in parallel. Default: 1.")
+    parser.add_argument("--region", nargs="+", help="The region to generate statistics for. Required unless --input is given. With several regions, each region's report is saved in its own subfolder of the output folder, next to an index comparing them.")
     parser.add_argument("-o", "--output", default="reports", help="The folder in which to store the generated files. Defaults to 'reports'. It is recommended to create a new subfolder in this directory for each report.")
-    parser.add_argument("-i", "--input", help="If provided, will not generate a new report and will format the existing JSON report as HTML files.")
+    parser.add_argument("-i", "--input", help="If provided, will not generate a new report and will format an existing report (report.mlr, or a report.json export) as HTML files.")
+    parser.add_argument("--json", action='store_true', help="Also export the whole report as human-readable JSON to report.json.")
+    parser.add_argument("--shard-size", default=0, type=int, help="If provided, category pages only show summaries, and their long lists (sender nations, templates, faithful recruits and the regions recruits left for) are written as JSON files of this many rows each, which the pages load on demand. The report then has to be served over HTTP (e.g. with python -m http.server) to be viewed.")
+    parser.add_argument("--profile", action='store_true', help="Record the wall time, CPU time, peak memory use so far and number of items processed of each step (and of each category), and save them in profile.json and profile.csv in the output folder.")
+    parser.add_argument("--cprofile", action='store_true', help="With --profile, also run each step under cProfile and save its statistics in the profile subfolder of the output folder.")
+    parser.add_argument("--no-cache", action='store_true', help="Generate the analytics of every template category again instead of reusing the ones cached by earlier runs on the same data dump.")
+    parser.add_argument("--no-manifest", action='store_true', help="Parse every telegram template export again instead of reusing the ones cached in the template folder's manifest.")
     parser.add_argument("-t", "--tg-source", default="telegrams", help="The folder to search for telegram template data. Defaults to 'telegrams'.")
     args = parser.parse_args()
 
-    nation_name = ""
+    if not args.input and not args.region:
+        parser.error("--region is required when generating a new report")
 
-    if len(args.nation_name) != 0:
-        nation_name = args.nation_name
-    else:
-        nation_name = input("Please enter your main nation name: ")
+    folder = args.output
+    os.makedirs(folder, exist_ok=True)
 
-    print("A: Downloading data dump and creating database")
+    telegrams = {}
+    registry = NationRegistry()
 
-    con = generate_database(nation_name, args.regenerate)
-    cursor = con.cursor()
+    overall_methods = {}
+    overall_nations = {}
 
-    folder = args.output
-    os.makedirs(folder, exist_ok=True)
+    report_path = f"{folder}/{REPORT_FILE}"
 
-    env = jinja2.Environment(loader=jinja2.FileSystemLoader("templates"))
-    env.filters['renderdate'] = renderDate
-    env.filters['items'] = items
-    env.filters['sorttop'] = sortTop
-    env.filters['sortstatstop'] = sortStatsTop
-    env.filters['sortbyhighest'] = sortByHighest
-    env.filters['sortstatsbyhighest'] = sortStatsByHighest
-    env.filters['methodname'] = methodName
-    env.filters['canonname'] = lambda nation: canonName(cursor, nation)
-    env.filters['displaynum'] = displayNumberWithCommas
+    # Reports for several regions are saved in a subfolder per region, and share everything but their analytics. region_analytics holds
+    # the overall analytics of each region's report, and the analytics of each of its categories.
+    regions = [None]
+    folders = [folder]
+    region_analytics: list[tuple[Analytics, dict[str, Analytics]]] = []
 
-    tgtemplate = env.get_template("telegram.html.jinja")
+    profiler = Profiler(f"{folder}/profile" if args.profile and args.cprofile else None)
 
-    print("B: Parsing telegram template data")
+    if args.input and is_report_file(args.input): # Load what the report needs from input, and everything only if it is exported as JSON
+        with profiler.stage("C-F", "load report") as stage:
+            reader = ReportReader(args.input)
+            overall_analytics, overall_methods, overall_nations = reader.overall()
+            telegrams = reader.telegrams(registry, args.json)
+            region_analytics.append((overall_analytics, {category: telegram.analytics for category, telegram in telegrams.items()}))
+            canon_names = reader.canon_names()
+            reader.close()
 
-    telegrams = {}
+            if not os.path.exists(report_path) or not os.path.samefile(args.input, report_path):
+                shutil.copyfile(args.input, report_path)
 
-    overall_analytics = Analytics.empty()
-    overall_methods = {}
-    overall_nations = {}
+            stage["items"] = len(telegrams)
+
+        print("C-F: Skipping all steps by loading data from the report")
 
-    if args.input: # Deserialize everything from input
-        input_json = None
-        with open(args.input, "r") as input_file:
-            input_json = json.load(input_file)
+    elif args.input: # Deserialize everything from a JSON report
+        with profiler.stage("C-F", "load JSON report") as stage:
+            input_json = None
+            with open(args.input, "r") as input_file:
+                input_json = json.load(input_file)
 
-        overall_analytics = Analytics.fromJSON(input_json["analytics"])
-        overall_methods = input_json["methods"]
-        overall_nations = input_json["nations"]
+            overall_analytics = Analytics.fromJSON(input_json["analytics"])
+            overall_methods = input_json["methods"]
+            overall_nations = input_json["nations"]
 
-        for k, v in overall_methods.items():
-            overall_methods[k] = Stats.fromJSON(v)
+            for k, v in overall_methods.items():
+                overall_methods[k] = Stats.fromJSON(v)
 
-        for k, v in overall_nations.items():
-            overall_nations[k] = Stats.fromJSON(v)
+            for k, v in overall_nations.items():
+                overall_nations[k] = Stats.fromJSON(v)
 
-        telegrams = input_json["telegrams"]
+            telegrams = input_json["telegrams"]
 
-        for k, v in telegrams.items():
-            telegrams[k] = Telegram.fromJSON(v)
+            for k, v in telegrams.items():
+                telegrams[k] = Telegram.fromJSON(v, registry)
+
+            # Older JSON reports don't have canonical names, in which case nations are shown under their API names.
+            canon_names = input_json.get("canon_names", {})
+
+            write_report(report_path, registry, telegrams, overall_analytics, overall_methods, overall_nations, canon_names)
+            region_analytics.append((overall_analytics, {category: telegram.analytics for category, telegram in telegrams.items()}))
+
+            stage["items"] = len(telegrams)
 
         print("C-F: Skipping all steps by loading data from JSON")
     
     else: # 10-minute-long computation yaay
-        telegrams = parse_template_folder(args.tg_source)
+        from src.report.datadump import generate_database, DUMP_URL
+        from src.report.parse import parse_template_folder
+        from src.report.analytics import generate_region_analytics, generate_analytics_parallel
+        from src.report.backend import SQLiteBackend, SnapshotBackend
+        from src.report.snapshot import load_snapshot
+        from src.report.cohorts import generate_region_cohorts, COHORT_BUCKETS
+        from src.report.filters import normalizeNationName
+        from src.report.cache import AnalyticsCache, analytics_key, dump_identity
 
-        for category, telegram in telegrams.items():
-            print(f"C: Generating analytics for template {category}")
-            telegram.analytics = generate_analytics(cursor, telegram, args.region, args.activity_threshold)
+        regions = list(dict.fromkeys(normalizeNationName(region) for region in args.region))
+        if len(regions) > 1:
+            folders = [os.path.join(folder, region) for region in regions]
+
+        nation_name = ""
+
+        if len(args.nation_name) != 0:
+            nation_name = args.nation_name
+        else:
+            nation_name = input("Please enter your main nation name: ")
+
+        print("A: Downloading data dump and creating database")
+
+        with profiler.stage("A", "dump database") as stage:
+            con, on_disk, updated = generate_database(nation_name, args.regenerate, args.stream, args.memory, args.save_memory, args.parse_jobs, args.refresh, args.dump_url or DUMP_URL)
+
+            if args.backend == "snapshot":
+                backend = SnapshotBackend(load_snapshot(con, args.regenerate or updated))
+            else:
+                backend = SQLiteBackend(con.cursor())
+
+            if args.profile:
+                stage["items"] = con.execute("SELECT COUNT(*) FROM nations").fetchone()[0]
+
+        history = None
+        if args.history:
+            with profiler.stage("A", "history"):
+                history = NationHistory(args.history)
+                history.ingest(con)
+
+        print("B: Parsing telegram template data")
+
+        with profiler.stage("B", "templates") as stage:
+            digests = {}
+            telegrams = parse_template_folder(args.tg_source, registry, not args.no_manifest, digests)
+            stage["items"] = sum(len(telegram.templates) for telegram in telegrams.values())
 
-            print(f"F: Adding analytics for template {category} to overall analytics")
-            overall_analytics.add(telegram.analytics)
+        # Categories whose template files are unchanged since an earlier run on the same dump, for the same regions and settings, reuse its analytics.
+        cache = None
+        cached = {}
+        if not args.no_cache:
+            with profiler.stage("C", "analytics cache") as stage:
+                cache = AnalyticsCache()
+                dump = dump_identity(con)
+                settings = [args.activity_threshold, sorted(args.activity_thresholds), args.retention_days, history.latest_snapshot() if history else None, args.cohort_bucket]
+                keys = {category: [analytics_key(category, digests[category], dump, region, settings) for region in regions] for category in telegrams}
+
+                for category, category_keys in keys.items():
+                    entries = [cache.get(key) for key in category_keys]
+                    if all(entries):
+                        cached[category] = entries
+
+                stage["items"] = len(cached)
+
+        pending = [telegram for category, telegram in telegrams.items() if category not in cached]
+
+        # The cohorts of all categories (for every region) are computed at once, before the analytics of each category.
+        with profiler.stage("C", "cohorts") as stage:
+            cohorts_by_region = generate_region_cohorts(backend, pending, regions, args.activity_threshold, COHORT_BUCKETS[args.cohort_bucket])
+            cohorts = {telegram.category: [region_cohorts[i] for region_cohorts in cohorts_by_region] for i, telegram in enumerate(pending)}
+            stage["items"] = sum(len(telegram.recruits) for telegram in pending)
+
+        # Workers open nations.db themselves, which isn't possible when the dump database only lives in this process' memory.
+        jobs = args.jobs
+        if jobs > 1 and args.backend == "sqlite" and not on_disk:
+            print("The data dump database only exists in memory, generating analytics in a single process")
+            jobs = 1
+
+        # Analytics items are the nations looked up: recruits and recipients. With several jobs, each category is recorded by the worker
+        # that generated its analytics, along with the whole pool.
+        if jobs > 1 and pending:
+            with profiler.stage("C-E", "analytics pool") as stage:
+                records = []
+                parallel_analytics = generate_analytics_parallel(pending, registry, jobs, args.backend, regions, args.activity_threshold,
+                    args.history, args.retention_days, args.activity_thresholds, records)
+                pending_analytics = {telegram.category: analytics for telegram, analytics in zip(pending, parallel_analytics)}
+
+                for telegram, record in zip(pending, records):
+                    record["items"] = len(telegram.recruits) + len(telegram.recipients)
+                    profiler.add(record)
+
+                stage["items"] = sum(len(telegram.recruits) + len(telegram.recipients) for telegram in pending)
+
+        # Each category is written to the report of every region as soon as its analytics are done. If the run fails or is interrupted,
+        # the unfinished reports are deleted.
+        with ExitStack() as stack:
+            writers = []
+            for region_folder in folders:
+                os.makedirs(region_folder, exist_ok=True)
+                writers.append(stack.enter_context(ReportWriter(f"{region_folder}/{REPORT_FILE}", registry)))
+                region_analytics.append((Analytics.empty(), {}))
+
+            for category, telegram in telegrams.items():
+                if category in cached:
+                    print(f"C: Reusing cached analytics for template {category}")
+                    category_analytics = cached[category]
+
+                else:
+                    if jobs == 1:
+                        print(f"C: Generating analytics for template {category}")
+
+                        with profiler.stage("C-E", "analytics", category) as stage:
+                            category_analytics = generate_region_analytics(backend, telegram, registry, regions, args.activity_threshold, history, args.retention_days, args.activity_thresholds)
+                            stage["items"] = len(telegram.recruits) + len(telegram.recipients)
+                    else:
+                        category_analytics = pending_analytics[category]
+
+                    for analytics, category_cohorts in zip(category_analytics, cohorts[category]):
+                        analytics.cohorts = category_cohorts
+
+                    if cache:
+                        for key, analytics in zip(keys[category], category_analytics):
+                            cache.put(key, analytics)
+
+                print(f"F: Adding analytics for template {category} to overall analytics")
+
+                with profiler.stage("F", "merge and write", category) as stage:
+                    for writer, analytics, (overall_analytics, analytics_by_category) in zip(writers, category_analytics, region_analytics):
+                        telegram.analytics = analytics
+                        writer.write_telegram(telegram)
+
+                        overall_analytics.merge(analytics)
+                        analytics_by_category[category] = analytics
+
+                    merge_into(overall_methods, telegram.methods)
+                    merge_into(overall_nations, telegram.nations)
+
+                    stage["items"] = len(telegram.templates)
+
+            with profiler.stage("F", "write report") as stage:
+                # Canonical names are stored in the report, so that it can be rendered again without the dump.
+                canon_names = resolve_canon_names(backend, telegrams, overall_nations)
+
+                for writer, region, (overall_analytics, _) in zip(writers, regions, region_analytics):
+                    writer.close(overall_analytics, overall_methods, overall_nations, {"canon_names": canon_names, "region": region})
+
+                if cache:
+                    cache.save()
+
+                stage["items"] = len(canon_names)
+
+    print(f"G: Generating final report as HTML")
+
+    for region, region_folder, (overall_analytics, analytics_by_category) in zip(regions, folders, region_analytics):
+        for category, telegram in telegrams.items():
+            telegram.analytics = analytics_by_category[category]
 
-            overall_methods = accumulate(overall_methods, telegram.methods, Stats.empty(), lambda base,other: base.join(other))
-            overall_nations = accumulate(overall_nations, telegram.nations, Stats.empty(), lambda base,other: base.join(other))
+        if args.json:
+            with profiler.stage("G", "JSON export", region) as stage:
+                json_output = {}
+                json_output["methods"] = overall_methods
+                json_output["nations"] = overall_nations
+                json_output["analytics"] = overall_analytics
+                json_output["telegrams"] = telegrams
+                json_output["canon_names"] = canon_names
+                with open(f"{region_folder}/report.json", "w") as output:
+                    json.dump(json_output, fp=output, indent=4, cls=MoonlarkEncoder, registry=registry)
 
-    print(f"G: Generating final report as HTML and JSON")
+                stage["items"] = len(telegrams)
 
-    json_output = {}
-    json_output["methods"] = overall_methods
-    json_output["nations"] = overall_nations
-    json_output["analytics"] = overall_analytics
-    json_output["telegrams"] = telegrams
-    with open(f"{folder}/report.json", "w") as output:
-        json.dump(json_output, fp=output, indent=4, cls=MoonlarkEncoder)
+        with profiler.stage("G", "render", region) as stage:
+            index_view = build_index_view(overall_analytics, overall_methods, overall_nations, telegrams, canon_names)
+            render_report(region_folder, list(telegrams.values()), canon_names, index_view, args.jobs, args.shard_size)
 
-    for category, telegram in telegrams.items():
-        result = tgtemplate.render(telegram=telegram)
+            stage["items"] = len(telegrams) + 1
 
-        with open(f"{folder}/{category}.html", "w") as output:
-            output.write(result)
+        print(f"H: HTML report saved in {region_folder}/index.html, report data saved in {region_folder}/{REPORT_FILE}" + (f" and {region_folder}/report.json" if args.json else ""))
 
-    index_template = env.get_template("index.html.jinja")
-    result = index_template.render(analytics=overall_analytics, methods=overall_methods, nations=overall_nations, telegrams=telegrams)
+    if len(regions) > 1:
+        with profiler.stage("G", "render comparison") as stage:
+            render_comparison(folder, build_comparison_view(regions, [overall_analytics for overall_analytics, _ in region_analytics], telegrams,
+                [analytics_by_category for _, analytics_by_category in region_analytics]))
+            stage["items"] = len(regions)
 
-    with open(f"{folder}/index.html", "w") as output:
-        output.write(result)
+        print(f"H: Comparison of the regions saved in {folder}/index.html")
 
-    print(f"H: HTML report saved in {folder}/index.html, JSON report saved in {folder}/report.json")
+    if args.profile:
+        profiler.write(folder)
+        print(f"H: Profile saved in {folder}/profile.json and {folder}/profile.csv")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
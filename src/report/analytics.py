@@ -1,72 +1,123 @@
-import sqlite3, time
-from .classes import Telegram, Analytics, Nation
-from progress.bar import ChargingBar
+import time, multiprocessing
+import numpy as np
+from dataclasses import replace
+from .classes import Telegram, Analytics, Activity, ACTIVITY_THRESHOLDS
+from .backend import DumpBackend, open_backend
+from .history import NationHistory, RETENTION_DAYS
+from .registry import NationRegistry
+from .profile import measure
 
-def format_database_data(data) -> Nation:
-    return Nation(data[0], data[1], data[2], data[3], data[4])
+DAY = 60 * 60 * 24
 
-def query_nation(cursor: sqlite3.Cursor, name: str) -> Nation | None:
-    cursor.execute("SELECT * FROM nations WHERE api_name = ?", [name])
-    data = cursor.fetchone()
+# Count the recruits that would be faithful at each activity threshold, given the last login and WA membership of the recruits still in the region.
+# Last logins are sorted once, and the number of recruits active within each threshold is then found with a binary search.
+def activity_sensitivity(lastlogin: np.ndarray, wa: np.ndarray, recruits: int, now: float, thresholds: list[int]) -> dict[str, Activity]:
+    cutoffs = now - DAY * np.array(thresholds, dtype=np.float64)
 
-    if data is None:
-        return None
+    active = np.sort(lastlogin)
+    wa_active = np.sort(lastlogin[wa])
+    faithful = len(active) - np.searchsorted(active, cutoffs, side="right")
+    wa_faithful = len(wa_active) - np.searchsorted(wa_active, cutoffs, side="right")
 
-    return format_database_data(data)
+    return {str(days): Activity(days, count, wa_count, recruits) for days, count, wa_count in zip(thresholds, faithful.tolist(), wa_faithful.tolist())}
 
-def canonName(cursor: sqlite3.Cursor, nation: str):
-    return query_nation(cursor,nation).canon_name
+# Resolve a category's recruits and recipients against the dump with one bulk lookup each, then compute its analytics for each of regions
+# with array operations, so that reports for several regions cost a single lookup. Analytics are returned in the same order as regions.
+# Recipients are deduplicated nation IDs (see NationRegistry), so a nation that received several telegrams is looked up and counted once.
+# Results keep the order in which nations appear in the telegram, so that lists and destination counts come out in a stable order.
+# If a history of past dumps is provided, the retention of recruits is also measured after each of retention_days days.
+# Faithful recruits are listed for inactivity_threshold, and counted for it and each of activity_thresholds.
+def generate_region_analytics(backend: DumpBackend, telegram: Telegram, registry: NationRegistry, regions: list[str], inactivity_threshold: int = 7, history: NationHistory | None = None,
+        retention_days: list[int] = RETENTION_DAYS, activity_thresholds: list[int] = ACTIVITY_THRESHOLDS) -> list[Analytics]:
+    results = []
 
-DAY = 60 * 60 * 24
+    print(f"D: Generating analytics for recruits of template {telegram.category}")
 
-def time_since_last_active(nation: Nation) -> float:
-    return time.time() - nation.lastlogin
+    recruits = [data for data in telegram.recruits.values() if not data.cte]
+    lookup = backend.lookup([data.name for data in recruits])
 
-def generate_analytics(cur: sqlite3.Cursor, telegram: Telegram, region: str, inactivity_threshold: int = 7) -> Analytics:
-    analytics = Analytics.empty()
+    now = time.time()
+    cutoff = now - (DAY * inactivity_threshold)
+    active = lookup.lastlogin > cutoff
+    thresholds = sorted({inactivity_threshold, *activity_thresholds})
 
-    analytics.stats = telegram.stats
-    analytics.timeRange = telegram.timeRange
+    for region in regions:
+        analytics = Analytics.empty()
 
-    print(f"D: Generating analytics for recruits of template {telegram.category}")
+        # Copies, since analytics are merged into each other in place.
+        analytics.stats = replace(telegram.stats)
+        analytics.timeRange = replace(telegram.timeRange)
+
+        in_region = lookup.in_region(region)
+        faithful = in_region & active
+
+        for i in np.flatnonzero(faithful):
+            analytics.faithful.append(recruits[i])
 
-    with ChargingBar('Generating', max=len(telegram.recruits)) as bar:
-        for nation, data in telegram.recruits.items():
-            if data.cte:
-                bar.next()
-                continue
+            if lookup.wa[i]:
+                analytics.wa_faithful.append(recruits[i])
 
-            nation_data = query_nation(cur, nation)
-            if nation_data:
-                if nation_data.region == region:
-                    if time_since_last_active(nation_data) < (DAY * inactivity_threshold):
-                        analytics.faithful.append(data)
+        analytics.traitor_destinations = lookup.count_regions(~in_region)
+        analytics.activity = activity_sensitivity(lookup.lastlogin[in_region], lookup.wa[in_region], telegram.stats.recruitCount, now, thresholds)
 
-                        if nation_data.wa:
-                            analytics.wa_faithful.append(data)
-                else:
-                    if nation_data.region not in analytics.traitor_destinations.keys():
-                        analytics.traitor_destinations[nation_data.region] = 0
-                    
-                    analytics.traitor_destinations[nation_data.region] += 1
+        if history:
+            analytics.retention = history.retention(recruits, region, retention_days)
 
-            bar.next()
+        results.append(analytics)
 
     print(f"E: Generating analytics for non-recruited recipients of template {telegram.category}")
 
-    with ChargingBar('Generating', max=len(telegram.recipients)) as bar:
-        for nation in telegram.recipients:
-            if nation in telegram.recruits.keys():
-                bar.next()
-                continue
-
-            nation_data = query_nation(cur, nation)
-            if nation_data and nation_data.region != region:
-                if nation_data.region not in analytics.uninterested_destinations.keys():
-                    analytics.uninterested_destinations[nation_data.region] = 0
-                    
-                analytics.uninterested_destinations[nation_data.region] += 1
-            
-            bar.next()
-
-    return analytics
\ No newline at end of file
+    recruit_ids = registry.intern_all(telegram.recruits.keys())
+    recipients = telegram.recipients[~np.isin(telegram.recipients, recruit_ids)]
+    lookup = backend.lookup(registry.names_of(recipients))
+
+    for region, analytics in zip(regions, results):
+        analytics.uninterested_destinations = lookup.count_regions(~lookup.in_region(region))
+
+    return results
+
+def generate_analytics(backend: DumpBackend, telegram: Telegram, registry: NationRegistry, region: str, inactivity_threshold: int = 7, history: NationHistory | None = None, retention_days: list[int] = RETENTION_DAYS,
+        activity_thresholds: list[int] = ACTIVITY_THRESHOLDS) -> Analytics:
+    return generate_region_analytics(backend, telegram, registry, [region], inactivity_threshold, history, retention_days, activity_thresholds)[0]
+
+# State of each worker process of generate_analytics_parallel, set up once by init_analytics_worker.
+worker_backend: DumpBackend | None = None
+worker_history: NationHistory | None = None
+worker_registry: NationRegistry | None = None
+worker_error: Exception | None = None
+
+# A pool replaces a worker whose initializer raises with a new one, forever. Errors are instead kept, and raised by every task the worker
+# is given, which stops the run.
+def init_analytics_worker(backend_kind: str, history_path: str | None, registry: NationRegistry):
+    global worker_backend, worker_history, worker_registry, worker_error
+    try:
+        worker_backend = open_backend(backend_kind)
+        worker_registry = registry
+        worker_history = NationHistory(history_path) if history_path else None
+    except Exception as e:
+        worker_error = e
+
+def analyse_category(task: tuple) -> list[Analytics]:
+    if worker_error:
+        raise worker_error
+
+    telegram, regions, inactivity_threshold, retention_days, activity_thresholds = task
+    print(f"C: Generating analytics for template {telegram.category}")
+    return measure("C-E", "analytics", telegram.category, generate_region_analytics, worker_backend, telegram, worker_registry, regions, inactivity_threshold,
+        worker_history, retention_days, activity_thresholds)
+
+# Generate the analytics of every category in a pool of jobs processes, each with its own read-only connection to the dump (and history)
+# and a copy of the registry the telegrams' nation IDs refer to.
+# Results are returned in the same order as the telegrams, regardless of which worker finishes first, each as a list of analytics per region.
+# If records is given, the profile record of each category (see measure) is added to it, in the same order.
+def generate_analytics_parallel(telegrams: list[Telegram], registry: NationRegistry, jobs: int, backend_kind: str, regions: list[str], inactivity_threshold: int = 7, history_path: str | None = None, retention_days: list[int] = RETENTION_DAYS,
+        activity_thresholds: list[int] = ACTIVITY_THRESHOLDS, records: list[dict] | None = None) -> list[list[Analytics]]:
+    tasks = [(telegram, regions, inactivity_threshold, retention_days, activity_thresholds) for telegram in telegrams]
+
+    with multiprocessing.Pool(jobs, initializer=init_analytics_worker, initargs=(backend_kind, history_path, registry)) as pool:
+        results = pool.map(analyse_category, tasks, chunksize=1)
+
+    if records is not None:
+        records.extend(record for _, record in results)
+
+    return [analytics for analytics, _ in results]
@@ -0,0 +1,143 @@
+import sqlite3
+import numpy as np
+from abc import ABC, abstractmethod
+from .classes import Nation, RegionCounts
+from .snapshot import NationSnapshot, SNAPSHOT_FILE
+from .paths import DUMP_DATABASE
+
+def format_database_data(data) -> Nation:
+    return Nation(data[0], data[1], data[2], data[3], data[4])
+
+def query_nation(cursor: sqlite3.Cursor, name: str) -> Nation | None:
+    cursor.execute("SELECT * FROM nations WHERE api_name = ?", [name])
+    data = cursor.fetchone()
+
+    if data is None:
+        return None
+
+    return format_database_data(data)
+
+# Dump attributes of a list of nations, as parallel arrays aligned with the names that were looked up.
+# Nations that don't exist anymore have found = False and a region ID of -1. region_index maps each region to its ID in regions.
+class NationLookup:
+    def __init__(self, found: np.ndarray, region_ids: np.ndarray, regions: list[str], region_index: dict[str, int], wa: np.ndarray, lastlogin: np.ndarray):
+        self.found = found
+        self.region_ids = region_ids
+        self.regions = regions
+        self.region_index = region_index
+        self.wa = wa
+        self.lastlogin = lastlogin
+
+    def region_id(self, region: str) -> int:
+        return self.region_index.get(region, -1)
+
+    def in_region(self, region: str) -> np.ndarray:
+        region_id = self.region_id(region)
+        if region_id == -1:
+            return np.zeros(len(self.found), dtype=bool)
+        return self.region_ids == region_id
+
+    # Count how many of the nations selected by mask are in each region, in order of first appearance.
+    def count_regions(self, mask: np.ndarray) -> RegionCounts:
+        selected = self.region_ids[mask & self.found]
+        ids, first, counts = np.unique(selected, return_index=True, return_counts=True)
+
+        return RegionCounts((self.regions[ids[i]], int(counts[i])) for i in np.argsort(first, kind="stable"))
+
+# Common interface to the nation data of a dump, implemented by both the SQLite database and the memory-mapped snapshot.
+class DumpBackend(ABC):
+    @abstractmethod
+    def lookup(self, names: list[str]) -> NationLookup:
+        pass
+
+    @abstractmethod
+    def query_nation(self, name: str) -> Nation | None:
+        pass
+
+    # Canonical names of the given nations, leaving out the ones that are not in the dump.
+    def canon_names(self, names: list[str]) -> dict[str, str]:
+        result = {}
+        for name in names:
+            nation = self.query_nation(name)
+            if nation:
+                result[name] = nation.canon_name
+        return result
+
+class SQLiteBackend(DumpBackend):
+    def __init__(self, cursor: sqlite3.Cursor):
+        self.cursor = cursor
+
+    # Resolve every name with a single join against a temporary table, rather than one query per nation.
+    def lookup(self, names: list[str]) -> NationLookup:
+        cur = self.cursor
+        cur.execute("CREATE TEMP TABLE lookup_names(seq INTEGER PRIMARY KEY, api_name TEXT NOT NULL)")
+        cur.executemany("INSERT INTO lookup_names VALUES(?, ?)", enumerate(names))
+
+        cur.execute("""SELECT n.region, n.wa, n.lastlogin FROM temp.lookup_names l LEFT JOIN nations n ON n.api_name = l.api_name
+            ORDER BY l.seq""")
+        rows = cur.fetchall()
+
+        cur.execute("DROP TABLE temp.lookup_names")
+
+        regions: dict[str, int] = {}
+        region_ids = np.fromiter((-1 if row[0] is None else regions.setdefault(row[0], len(regions)) for row in rows), dtype=np.int64, count=len(rows))
+        wa = np.fromiter((bool(row[1]) for row in rows), dtype=bool, count=len(rows))
+        lastlogin = np.fromiter((row[2] or 0 for row in rows), dtype=np.int64, count=len(rows))
+
+        return NationLookup(region_ids != -1, region_ids, list(regions), regions, wa, lastlogin)
+
+    def query_nation(self, name: str) -> Nation | None:
+        return query_nation(self.cursor, name)
+
+    def canon_names(self, names: list[str]) -> dict[str, str]:
+        cur = self.cursor
+        cur.execute("CREATE TEMP TABLE lookup_names(seq INTEGER PRIMARY KEY, api_name TEXT NOT NULL)")
+        cur.executemany("INSERT INTO lookup_names VALUES(?, ?)", enumerate(names))
+
+        cur.execute("SELECT n.api_name, n.canon_name FROM temp.lookup_names l JOIN nations n ON n.api_name = l.api_name")
+        result = dict(cur.fetchall())
+
+        cur.execute("DROP TABLE temp.lookup_names")
+
+        return result
+
+class SnapshotBackend(DumpBackend):
+    def __init__(self, snapshot: NationSnapshot):
+        self.snapshot = snapshot
+
+    def lookup(self, names: list[str]) -> NationLookup:
+        snapshot = self.snapshot
+        rows = snapshot.find(names)
+        found = rows != -1
+        rows = np.where(found, rows, 0)
+
+        if snapshot.count == 0:
+            return NationLookup(found, np.full(len(names), -1, dtype=np.int64), snapshot.regions, snapshot.region_index, found, np.zeros(len(names), dtype=np.int64))
+
+        region_ids = np.where(found, snapshot.region_ids[rows].astype(np.int64), -1)
+        wa = found & snapshot.wa(rows)
+        lastlogin = np.where(found, snapshot.lastlogin[rows], 0)
+
+        return NationLookup(found, region_ids, snapshot.regions, snapshot.region_index, wa, lastlogin)
+
+    def query_nation(self, name: str) -> Nation | None:
+        snapshot = self.snapshot
+        row = int(snapshot.find([name])[0])
+
+        if row == -1:
+            return None
+
+        rows = np.array([row])
+        return Nation(snapshot.canon_name(row), name, snapshot.regions[snapshot.region_ids[row]], bool(snapshot.wa(rows)[0]), int(snapshot.lastlogin[row]))
+
+    def canon_names(self, names: list[str]) -> dict[str, str]:
+        rows = self.snapshot.find(names)
+        return {name: self.snapshot.canon_name(row) for name, row in zip(names, rows.tolist()) if row != -1}
+
+# Open a new, read-only backend of the given kind ("sqlite" or "snapshot") from the files on disk, e.g. in a worker process.
+def open_backend(kind: str) -> DumpBackend:
+    if kind == "snapshot":
+        return SnapshotBackend(NationSnapshot(SNAPSHOT_FILE))
+
+    con = sqlite3.connect(f"file:{DUMP_DATABASE}?mode=ro", uri=True)
+    return SQLiteBackend(con.cursor())
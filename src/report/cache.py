@@ -0,0 +1,76 @@
+import os, json, time, zlib, marshal, hashlib, sqlite3
+from .classes import Analytics
+from .reportfile import to_json
+from .datadump import dump_metadata
+
+# Analytics of each category from earlier runs, kept in the working directory next to nations.db.
+ANALYTICS_CACHE = "analytics.cache"
+
+# Bump this whenever what analytics hold or how they are computed changes, so that old results are discarded.
+CACHE_VERSION = 1
+
+# Identifies the dump behind the database: the ETag and Last-Modified date it was downloaded with, or for databases built without them,
+# its most recent login and number of nations (see NationHistory.ingest).
+def dump_identity(con: sqlite3.Connection) -> list:
+    metadata = dump_metadata(con)
+    if metadata and (metadata.etag or metadata.last_modified):
+        return [metadata.etag, metadata.last_modified]
+
+    return list(con.execute("SELECT MAX(lastlogin), COUNT(*) FROM nations").fetchone())
+
+# Day of the run (in UTC), as part of the key: faithful recruits are counted against the time of the run, so analytics computed on another
+# day would be measured against a different "now" than the categories computed today.
+def run_day() -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime())
+
+# Key of the analytics of a category: the content hashes of its template files (in any order), the dump, the day of the run, the region,
+# and any settings that change the results (activity thresholds, retention days, cohort buckets...). Settings must be JSON-serializable.
+def analytics_key(category: str, digests: list[bytes], dump: list, region: str, settings: list) -> str:
+    fingerprint = [CACHE_VERSION, category, sorted(digest.hex() for digest in digests), dump, run_day(), region, settings]
+    return hashlib.sha256(json.dumps(fingerprint).encode("utf-8")).hexdigest()
+
+# Cache of category analytics, stored as compressed JSON by key. Faithful recruits are measured against the time of the run that
+# computed them, so results are only reused for the same dump on the same day. Like TemplateManifest, entries that weren't
+# used by the last run are dropped when saving, which also drops the results of older dumps.
+class AnalyticsCache:
+    def __init__(self, path: str = ANALYTICS_CACHE):
+        self.path = path
+        self.entries: dict[str, bytes] = {}
+        self.used: set[str] = set()
+        self.changed = False
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "rb") as f:
+                    data = marshal.load(f)
+                if data.get("version") == CACHE_VERSION:
+                    self.entries = data["entries"]
+            except (EOFError, ValueError, TypeError, AttributeError):
+                print(f"Ignoring unreadable analytics cache {self.path}")
+
+    def get(self, key: str) -> Analytics | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        self.used.add(key)
+        return Analytics.fromJSON(json.loads(zlib.decompress(entry)))
+
+    def put(self, key: str, analytics: Analytics):
+        self.entries[key] = zlib.compress(to_json(analytics), 1)
+        self.used.add(key)
+        self.changed = True
+
+    def save(self):
+        removed = [key for key in self.entries.keys() if key not in self.used]
+        for key in removed:
+            del self.entries[key]
+
+        if not self.changed and not removed:
+            return
+
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            marshal.dump({"version": CACHE_VERSION, "entries": self.entries}, f)
+
+        os.replace(temporary_path, self.path)
@@ -1,16 +1,21 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
+import numpy as np
 from .filters import renderRate
+from .registry import NationRegistry, unique_ids
 
-def accumulate(dest: dict, src: dict, default, add_callback) -> dict:
-    result = {}
-    result.update(dest)
+# The aggregate types below (Stats, TimeRange, RegionCounts, Retention, Activity, Analytics) are monoids: empty() is the identity and merge() combines
+# another value into this one in place. Merges are associative, so partial results (e.g. per category or per worker) can be combined in any grouping.
 
-    for element, value in src.items():
-        if element not in result.keys():
-            result[element] = default
-        result[element] = add_callback(result[element],value)
+# Merge every value of src into the value with the same key in dest, in place. Keys missing from dest get a copy of the value from src,
+# so that dest never shares objects with src.
+def merge_into(dest: dict, src: dict) -> dict:
+    for key, value in src.items():
+        if key in dest:
+            dest[key].merge(value)
+        else:
+            dest[key] = replace(value)
 
-    return result
+    return dest
 
 @dataclass
 class Recruit:
@@ -36,20 +41,11 @@ class Stats:
     readCount: int
     recruitCount: int
 
-    def add(self, other):
+    def merge(self, other):
         self.delivered += other.delivered
         self.readCount += other.readCount
         self.recruitCount += other.recruitCount
 
-    def join(self, other):
-        result = Stats.empty()
-
-        result.delivered = self.delivered + other.delivered
-        result.readCount = self.readCount + other.readCount
-        result.recruitCount = self.recruitCount + other.recruitCount
-
-        return result
-
     @property
     def readRate(self):
         return renderRate(self.delivered, self.readCount)
@@ -86,19 +82,134 @@ class TimeRange:
     def try_add_end(self, end: int):
         if end > self.end:
             self.end = end
+
+    def merge(self, other):
+        self.try_add_start(other.start)
+        self.try_add_end(other.end)
     
     @staticmethod
     def fromJSON(src: dict):
         return TimeRange(src["start"], src["end"])
 
+# Number of nations per region. New regions are appended when merging, so the order in which regions were first seen is preserved.
+class RegionCounts(dict[str, int]):
+    def merge(self, other):
+        for region, count in other.items():
+            self[region] = self.get(region, 0) + count
+
+@dataclass
+class Retention:
+    days: int
+    retained: int
+    measured: int
+
+    def merge(self, other):
+        self.retained += other.retained
+        self.measured += other.measured
+
+    @property
+    def retentionRate(self):
+        return renderRate(self.measured, self.retained)
+
+    @staticmethod
+    def fromJSON(src: dict):
+        return Retention(src["days"], src["retained"], src["measured"])
+
+# Activity thresholds, in days, at which faithful recruits are counted by default, in addition to the main one.
+ACTIVITY_THRESHOLDS = [1, 3, 7, 14, 30]
+
+# Number of recruits that would be counted as faithful (and WA faithful) if the activity threshold was days days, out of recruits.
+@dataclass
+class Activity:
+    days: int
+    faithful: int
+    waFaithful: int
+    recruits: int
+
+    def merge(self, other):
+        self.faithful += other.faithful
+        self.waFaithful += other.waFaithful
+        self.recruits += other.recruits
+
+    @property
+    def preserveRate(self):
+        return renderRate(self.recruits, self.faithful)
+
+    @property
+    def waPreserveRate(self):
+        return renderRate(self.recruits, self.waFaithful)
+
+    @staticmethod
+    def fromJSON(src: dict):
+        return Activity(src["days"], src["faithful"], src["waFaithful"], src["recruits"])
+
+# Adds values into the list dest element-wise, starting at index offset, growing dest as needed.
+def add_at(dest: list[int], values: list[int], offset: int):
+    dest.extend([0] * (offset + len(values) - len(dest)))
+    for i, value in enumerate(values):
+        dest[offset + i] += value
+
+# Recruitment over time: the number of recruits recruited in each time bucket (of bucket seconds, the first one starting at start),
+# and how many of them are faithful, WA faithful, or went to each of the main destination regions.
+@dataclass
+class Cohorts:
+    bucket: int
+    start: int
+    recruits: list[int]
+    faithful: list[int]
+    waFaithful: list[int]
+    destinations: dict[str, list[int]]
+
+    @property
+    def bucketCount(self):
+        return len(self.recruits)
+
+    @staticmethod
+    def empty():
+        return Cohorts(0, 0, [], [], [], {})
+
+    # Buckets always start at multiples of the bucket size from the same origin, so cohorts with the same bucket size can be lined up.
+    def merge(self, other):
+        if other.bucketCount == 0:
+            return
+
+        if self.bucketCount == 0:
+            self.bucket, self.start = other.bucket, other.start
+
+        if other.bucket != self.bucket:
+            raise ValueError("Cannot merge cohorts with different bucket sizes")
+
+        if other.start < self.start:
+            shift = (self.start - other.start) // self.bucket
+            for values in [self.recruits, self.faithful, self.waFaithful, *self.destinations.values()]:
+                values[:0] = [0] * shift
+            self.start = other.start
+
+        offset = (other.start - self.start) // self.bucket
+        add_at(self.recruits, other.recruits, offset)
+        add_at(self.faithful, other.faithful, offset)
+        add_at(self.waFaithful, other.waFaithful, offset)
+        for region, counts in other.destinations.items():
+            add_at(self.destinations.setdefault(region, []), counts, offset)
+
+        for values in [self.faithful, self.waFaithful, *self.destinations.values()]:
+            values.extend([0] * (len(self.recruits) - len(values)))
+
+    @staticmethod
+    def fromJSON(src: dict):
+        return Cohorts(src["bucket"], src["start"], src["recruits"], src["faithful"], src["waFaithful"], src["destinations"])
+
 @dataclass
 class Analytics:
     stats: Stats
     faithful: list[Recruit]
     wa_faithful: list[Recruit]
-    traitor_destinations: dict[str, int]
-    uninterested_destinations: dict[str, int]
+    traitor_destinations: RegionCounts
+    uninterested_destinations: RegionCounts
     timeRange: TimeRange
+    retention: dict[str, Retention]
+    cohorts: Cohorts
+    activity: dict[str, Activity]
 
     @property
     def faithfulCount(self):
@@ -110,18 +221,20 @@ class Analytics:
 
     @staticmethod
     def empty():
-        return Analytics(Stats.empty(), [], [], {}, {}, TimeRange.default())
+        return Analytics(Stats.empty(), [], [], RegionCounts(), RegionCounts(), TimeRange.default(), {}, Cohorts.empty(), {})
     
-    def add(self, other):
+    def merge(self, other):
         self.faithful += other.faithful
         self.wa_faithful += other.wa_faithful
-        self.stats.add(other.stats)
+        self.stats.merge(other.stats)
+        self.timeRange.merge(other.timeRange)
 
-        self.timeRange.try_add_start(other.timeRange.start)
-        self.timeRange.try_add_end(other.timeRange.end)
+        self.traitor_destinations.merge(other.traitor_destinations)
+        self.uninterested_destinations.merge(other.uninterested_destinations)
 
-        self.traitor_destinations = accumulate(self.traitor_destinations, other.traitor_destinations, 0, lambda a, b: a+b)
-        self.uninterested_destinations = accumulate(self.uninterested_destinations, other.uninterested_destinations, 0, lambda a, b: a+b)
+        merge_into(self.retention, other.retention)
+        self.cohorts.merge(other.cohorts)
+        merge_into(self.activity, other.activity)
 
     @property
     def preserveRate(self):
@@ -133,7 +246,7 @@ class Analytics:
     
     @staticmethod
     def fromJSON(src: dict):
-        return Analytics(Stats.fromJSON(src["stats"]), [Recruit.fromJSON(s) for s in src["faithful"]], [Recruit.fromJSON(s) for s in src["wa_faithful"]], src["traitor_destinations"], src["uninterested_destinations"], TimeRange.fromJSON(src["timeRange"]))
+        return Analytics(Stats.fromJSON(src["stats"]), [Recruit.fromJSON(s) for s in src["faithful"]], [Recruit.fromJSON(s) for s in src["wa_faithful"]], RegionCounts(src["traitor_destinations"]), RegionCounts(src["uninterested_destinations"]), TimeRange.fromJSON(src["timeRange"]), {k: Retention.fromJSON(v) for k, v in src.get("retention", {}).items()}, Cohorts.fromJSON(src["cohorts"]) if "cohorts" in src else Cohorts.empty(), {k: Activity.fromJSON(v) for k, v in src.get("activity", {}).items()})
 
 class TelegramTemplate:
     tgid: int
@@ -142,11 +255,11 @@ class TelegramTemplate:
     category: str
     timeRange: TimeRange
     stats: Stats
-    recipients: list[str]
+    recipients: np.ndarray # Nation IDs, see NationRegistry
     recruits: dict[str, Recruit]
 
     @staticmethod
-    def fromJSON(src: dict):
+    def fromJSON(src: dict, registry: NationRegistry):
         tgtemplate = TelegramTemplate()
         tgtemplate.tgid = src["tgid"]
         tgtemplate.type = src["type"]
@@ -154,7 +267,7 @@ class TelegramTemplate:
         tgtemplate.category = src["category"]
         tgtemplate.timeRange = TimeRange.fromJSON(src["timeRange"])
         tgtemplate.stats = Stats.fromJSON(src["stats"])
-        tgtemplate.recipients = src["recipients"]
+        tgtemplate.recipients = unique_ids(registry.intern_all(src["recipients"]))
         tgtemplate.recruits = src["recruits"]
 
         for k, v in tgtemplate.recruits.items():
@@ -165,7 +278,7 @@ class TelegramTemplate:
 class Telegram:
     stats: Stats
     category: str
-    recipients: list[str]
+    recipients: np.ndarray # Nation IDs, see NationRegistry
     recruits: dict[str, Recruit]
     templates: list[TelegramTemplate]
     methods: dict[str, Stats]
@@ -174,17 +287,17 @@ class Telegram:
     analytics: Analytics
 
     @staticmethod
-    def fromJSON(src: dict):
+    def fromJSON(src: dict, registry: NationRegistry):
         tg = Telegram()
         tg.stats = Stats.fromJSON(src["stats"])
         tg.category = src["category"]
-        tg.recipients = src["recipients"]
+        tg.recipients = unique_ids(registry.intern_all(src["recipients"]))
         tg.recruits = src["recruits"]
 
         for k, v in tg.recruits.items():
             tg.recruits[k] = Recruit.fromJSON(v)
 
-        tg.templates = [TelegramTemplate.fromJSON(s) for s in src["templates"]]
+        tg.templates = [TelegramTemplate.fromJSON(s, registry) for s in src["templates"]]
 
         tg.methods = src["methods"]
         tg.nations = src["nations"]
@@ -0,0 +1,103 @@
+import time
+import numpy as np
+from typing import TYPE_CHECKING
+from .classes import Cohorts, Telegram
+
+# Only needed for type hints, since view.py imports this module when rendering an existing report.
+if TYPE_CHECKING:
+    from .backend import DumpBackend
+
+DAY = 60 * 60 * 24
+
+# Sizes of the time buckets cohorts can be grouped by.
+COHORT_BUCKETS = {"day": DAY, "week": 7 * DAY}
+
+# Buckets start at multiples of the bucket size from this origin, a Monday (January 5, 1970), so that weeks run from Monday to Sunday.
+COHORT_ORIGIN = 4 * DAY
+
+# Number of destination regions tracked over time in each category: the ones most recruits left for.
+COHORT_DESTINATIONS = 5
+
+# Compute the cohorts of every category at once, for each of regions. The recruits of all categories are packed into arrays and resolved
+# against the dump with a single lookup, then counted per (category, bucket) with bincount. Recruits who ceased to exist are counted as
+# recruits, but can't be faithful or have a destination, like in generate_analytics. Returns the cohorts of each category, per region.
+def generate_region_cohorts(backend: "DumpBackend", telegrams: list[Telegram], regions: list[str], inactivity_threshold: int = 7, bucket: int = COHORT_BUCKETS["week"]) -> list[list[Cohorts]]:
+    recruits = [(i, recruit) for i, telegram in enumerate(telegrams) for recruit in telegram.recruits.values()]
+    if len(recruits) == 0:
+        return [[Cohorts.empty() for _ in telegrams] for _ in regions]
+
+    categories = np.fromiter((i for i, _ in recruits), dtype=np.int64, count=len(recruits))
+    recruitedAt = np.fromiter((recruit.recruitedAt for _, recruit in recruits), dtype=np.int64, count=len(recruits))
+    cte = np.fromiter((recruit.cte for _, recruit in recruits), dtype=bool, count=len(recruits))
+
+    names, inverse = np.unique(np.array([recruit.name for _, recruit in recruits], dtype=object), return_inverse=True)
+    lookup = backend.lookup(names.tolist())
+
+    found = lookup.found[inverse] & ~cte
+    region_ids = lookup.region_ids[inverse]
+    active = lookup.lastlogin[inverse] > time.time() - DAY * inactivity_threshold
+    wa = lookup.wa[inverse]
+
+    buckets = (recruitedAt - COHORT_ORIGIN) // bucket
+    first, count = int(buckets.min()), int(buckets.max() - buckets.min() + 1)
+
+    # Every (category, bucket) pair gets a single index, so that each series is counted for all categories with one bincount.
+    cells = categories * count + (buckets - first)
+    shape = (len(telegrams), count)
+
+    def per_bucket(mask: np.ndarray) -> np.ndarray:
+        return np.bincount(cells[mask], minlength=shape[0] * shape[1]).reshape(shape)
+
+    recruit_counts = per_bucket(np.ones(len(recruits), dtype=bool))
+
+    # Each category is trimmed to the buckets between its first and last recruit.
+    ranges = []
+    for i in range(len(telegrams)):
+        recruited = np.flatnonzero(recruit_counts[i])
+        ranges.append((int(recruited[0]), int(recruited[-1]) + 1) if len(recruited) else None)
+
+    name_ranks = np.argsort(np.argsort(np.array(lookup.regions, dtype=object)))
+
+    results = []
+    for region in regions:
+        in_region = found & (region_ids == lookup.region_id(region))
+        faithful = in_region & active
+        left = found & ~in_region
+
+        faithful_counts = per_bucket(faithful)
+        wa_faithful_counts = per_bucket(faithful & wa)
+
+        # Destinations are counted per (category, region) to find the top ones of each category, which are then counted per
+        # (category, rank, bucket) with a single bincount as well.
+        destination_totals = np.zeros((len(telegrams), len(lookup.regions)), dtype=np.int64)
+        np.add.at(destination_totals, (categories[left], region_ids[left]), 1)
+
+        # Ties are broken by region name, as region IDs depend on which nations were looked up.
+        names_order = np.broadcast_to(name_ranks, destination_totals.shape)
+        top = np.lexsort((names_order, -destination_totals), axis=1)[:, :COHORT_DESTINATIONS]
+        ranks = np.full(destination_totals.shape, -1, dtype=np.int64)
+        np.put_along_axis(ranks, top, np.arange(top.shape[1]), axis=1)
+
+        rank = ranks[categories[left], region_ids[left]]
+        destination_cells = (categories[left] * COHORT_DESTINATIONS + rank) * count + (buckets[left] - first)
+        destination_counts = np.bincount(destination_cells[rank >= 0], minlength=len(telegrams) * COHORT_DESTINATIONS * count).reshape(len(telegrams), COHORT_DESTINATIONS, count)
+
+        region_cohorts = []
+        for i, trimmed in enumerate(ranges):
+            if trimmed is None:
+                region_cohorts.append(Cohorts.empty())
+                continue
+            start, end = trimmed
+
+            destinations = {lookup.regions[region_id]: destination_counts[i, r, start:end].tolist()
+                for r, region_id in enumerate(top[i].tolist()) if destination_totals[i, region_id] > 0}
+
+            region_cohorts.append(Cohorts(bucket, COHORT_ORIGIN + (first + start) * bucket, recruit_counts[i, start:end].tolist(), faithful_counts[i, start:end].tolist(),
+                wa_faithful_counts[i, start:end].tolist(), destinations))
+
+        results.append(region_cohorts)
+
+    return results
+
+def generate_cohorts(backend: "DumpBackend", telegrams: list[Telegram], region: str, inactivity_threshold: int = 7, bucket: int = COHORT_BUCKETS["week"]) -> list[Cohorts]:
+    return generate_region_cohorts(backend, telegrams, [region], inactivity_threshold, bucket)[0]
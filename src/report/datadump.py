@@ -1,65 +1,535 @@
-import os, gzip, requests, sqlite3
+import os, io, gzip, json, shutil, queue, threading, itertools, multiprocessing, requests, sqlite3
 import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+from typing import Iterable, Iterator
 from .filters import normalizeNationName
+from .paths import DUMP_DATABASE
 
-def download_nation_data_dump(nation: str) -> None:
-    url = 'https://www.nationstates.net/pages/nations.xml.gz'
-    headers = {'Accept': 'application/gzip', 'User-Agent': f"Moonlark (report generator) by Merethin, used by {nation}"}
+DUMP_URL = 'https://www.nationstates.net/pages/nations.xml.gz'
+
+DUMP_FILE = "nations.xml.gz"
+
+# Size of the chunks the dump is read from the network in. If the connection breaks, the chunk being read is lost.
+NETWORK_CHUNK_SIZE = 64 * 1024
+
+# Size of the buffered writes of a downloaded dump to disk.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Bump this whenever the layout of the nations table changes, so that existing databases get rebuilt.
+DUMP_SCHEMA_VERSION = 1
+
+# Number of rows handed to each executemany() call when inserting the dump.
+BATCH_SIZE = 10000
+
+# Approximate size of the byte ranges of the decompressed dump handed to each worker when parsing in parallel.
+PARSE_RANGE_SIZE = 8 * 1024 * 1024
+
+def dump_request_headers(nation: str) -> dict:
+    return {'Accept': 'application/gzip', 'User-Agent': f"Moonlark (report generator) by Merethin, used by {nation}"}
+
+# What identifies a version of the dump on the server, as sent in its response headers.
+@dataclass
+class DumpMetadata:
+    etag: str | None
+    last_modified: str | None
+    size: int | None
+
+    # Headers that make the server answer 304 Not Modified if the dump is still this version.
+    def conditional_headers(self) -> dict:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    # Strong validator for If-Range, so that a download is only resumed if the dump is still this version.
+    @property
+    def validator(self) -> str | None:
+        if self.etag and not self.etag.startswith("W/"):
+            return self.etag
+        return self.last_modified
+
+    # The size is that of the whole dump, even for a partial (206) response, and unknown if the content is re-encoded in transit.
+    @staticmethod
+    def fromResponse(r: requests.Response):
+        size = None
+        if r.status_code == 206:
+            total = r.headers.get("Content-Range", "").rpartition("/")[2]
+            size = int(total) if total.isdigit() else None
+        elif "Content-Length" in r.headers and "Content-Encoding" not in r.headers:
+            size = int(r.headers["Content-Length"])
+
+        return DumpMetadata(r.headers.get("ETag"), r.headers.get("Last-Modified"), size)
+
+    @staticmethod
+    def fromJSON(src: dict):
+        return DumpMetadata(src["etag"], src["last_modified"], src["size"])
+
+# Metadata of the dump a database was built from, if it was recorded.
+def dump_metadata(con: sqlite3.Connection) -> DumpMetadata | None:
+    try:
+        row = con.execute("SELECT etag, last_modified, size FROM dump_metadata").fetchone()
+        return DumpMetadata(*row) if row else None
+    except sqlite3.OperationalError: # Databases built before the metadata was recorded.
+        return None
+
+def read_dump_metadata(path: str) -> DumpMetadata | None:
+    con = sqlite3.connect(path)
+    try:
+        return dump_metadata(con)
+    finally:
+        con.close()
+
+def write_dump_metadata(cursor: sqlite3.Cursor, metadata: DumpMetadata) -> None:
+    cursor.execute("CREATE TABLE IF NOT EXISTS dump_metadata(etag TEXT, last_modified TEXT, size INTEGER)")
+    cursor.execute("DELETE FROM dump_metadata")
+    cursor.execute("INSERT INTO dump_metadata VALUES(?, ?, ?)", [metadata.etag, metadata.last_modified, metadata.size])
+
+# Ask the server whether the dump is still the version described by metadata, with a HEAD request so that nothing is downloaded.
+def dump_unchanged(nation: str, metadata: DumpMetadata, url: str = DUMP_URL) -> bool:
+    conditional = metadata.conditional_headers()
+    if not conditional:
+        return False
+
+    r = requests.head(url, headers={**dump_request_headers(nation), **conditional}, allow_redirects=True)
+    if r.status_code == 304:
+        return True
+    r.raise_for_status()
+    return False
+
+# Check that a downloaded dump has the size announced by the server. Its gzip checksum is verified when it is parsed.
+def verify_nation_data_dump(path: str, metadata: DumpMetadata) -> None:
+    size = os.path.getsize(path)
+    if metadata.size is not None and size != metadata.size:
+        raise OSError(f"Downloaded data dump is {size} bytes long, expected {metadata.size}")
+
+# Download the dump to path. It is first written to path.part, with its metadata in path.part.json, so that an interrupted download
+# is resumed with a Range request by the next call, unless the dump changed on the server in the meantime. The size of the download is
+# checked before it is moved to path; one of the wrong size is deleted. Returns the metadata of the downloaded dump.
+def download_nation_data_dump(nation: str, path: str = DUMP_FILE, url: str = DUMP_URL) -> DumpMetadata:
+    headers = dump_request_headers(nation)
+    partial = path + ".part"
+    partial_metadata = partial + ".json"
+
+    offset = 0
+    metadata = None
+    if os.path.exists(partial) and os.path.exists(partial_metadata):
+        with open(partial_metadata) as f:
+            metadata = DumpMetadata.fromJSON(json.load(f))
+
+        offset = os.path.getsize(partial)
+        if metadata.validator and offset > 0:
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = metadata.validator
 
     print(f"Downloading data dump from {url}")
     print(f"Headers = {headers}")
 
     with requests.get(url, headers=headers, stream=True) as r:
+        # The part already downloaded is the whole dump, or longer than it: start over.
+        if r.status_code == 416:
+            os.remove(partial)
+            return download_nation_data_dump(nation, path, url)
+
         r.raise_for_status()
-        with open("nations.xml.gz", 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
+
+        if r.status_code == 206:
+            print(f"Resuming interrupted download after {offset} bytes")
+        else:
+            offset = 0
+            metadata = DumpMetadata.fromResponse(r)
+            with open(partial_metadata, "w") as f:
+                json.dump(vars(metadata), f)
+
+        with open(partial, "ab" if offset > 0 else "wb", buffering=DOWNLOAD_CHUNK_SIZE) as f:
+            for chunk in r.iter_content(chunk_size=NETWORK_CHUNK_SIZE):
                 f.write(chunk)
-    
-    with gzip.open("nations.xml.gz", 'rb') as f:
-        file_content = f.read()
-        with open("nations.xml", 'wb') as output:
-            output.write(file_content)
-    
-    os.remove("nations.xml.gz")
 
-# Extract nation data from the nations.xml data dump.
-def parse_nation_data(filename: str) -> list[tuple]:
-    tree = ET.parse(filename)
-    root = tree.getroot()
+    try:
+        verify_nation_data_dump(partial, metadata)
+    except OSError:
+        os.remove(partial)
+        os.remove(partial_metadata)
+        raise
+
+    os.replace(partial, path)
+    os.remove(partial_metadata)
+
+    return metadata
+
+def format_nation_element(nation: ET.Element) -> tuple:
+    canon_name = nation.find("NAME").text
+    api_name = normalizeNationName(canon_name)
+    region = normalizeNationName(nation.find("REGION").text)
+    wa = False
+    if nation.find("UNSTATUS").text == "WA Member":
+        wa = True
+    lastlogin = int(nation.find("LASTLOGIN").text)
+
+    return (canon_name, api_name, region, wa, lastlogin)
+
+# Extract nation data from a nations.xml data dump (either a binary file object or a path to the compressed nations.xml.gz), one nation at a time.
+# Each <NATION> element is discarded as soon as its row has been produced, so memory use stays flat regardless of the size of the dump.
+def parse_nation_data(source) -> Iterator[tuple]:
+    if isinstance(source, str):
+        with gzip.open(source, 'rb') as f:
+            yield from parse_nation_data(f)
+        return
+
+    context = ET.iterparse(source, events=("start", "end"))
+    _, root = next(context)
+
+    for event, element in context:
+        if event == "end" and element.tag == "NATION":
+            yield format_nation_element(element)
+            root.clear()
+
+def decompress_nation_data_dump(source: str, destination: str) -> None:
+    with gzip.open(source, 'rb') as f:
+        with open(destination, 'wb') as output:
+            shutil.copyfileobj(f, output, 1024 * 1024)
+
+# Find the first occurrence of pattern at or after offset, reading the file in blocks. Returns -1 if it is not found.
+def find_in_file(f, pattern: bytes, offset: int) -> int:
+    block_size = 1024 * 1024
+    f.seek(offset)
+    carry = b""
+
+    while True:
+        block = f.read(block_size)
+        if not block:
+            return -1
+
+        data = carry + block
+        index = data.find(pattern)
+        if index != -1:
+            return offset - len(carry) + index
+
+        carry = data[-(len(pattern) - 1):]
+        offset += len(block)
+
+# Split a decompressed nations.xml into byte ranges that each start at a <NATION> and end right after a </NATION>.
+# Returns the XML prolog (everything before the first nation, including the opening <NATIONS> tag) along with the ranges.
+def split_nation_data(filename: str, range_size: int = PARSE_RANGE_SIZE) -> tuple[bytes, list[tuple[int, int]]]:
+    closing_tag = b"</NATION>"
+    ranges = []
+
+    with open(filename, 'rb') as f:
+        first = find_in_file(f, b"<NATION>", 0)
+
+        f.seek(0)
+        if first == -1:
+            return f.read(), []
+
+        prolog = f.read(first)
+
+        # Only the closing </NATIONS> tag follows the last nation, so it is enough to look at the tail of the file.
+        size = f.seek(0, os.SEEK_END)
+        tail_start = max(first, size - 65536)
+        f.seek(tail_start)
+        last = tail_start + f.read().rfind(closing_tag) + len(closing_tag)
+
+        start = first
+        while start < last:
+            end = find_in_file(f, closing_tag, start + range_size)
+            if end == -1 or end + len(closing_tag) > last:
+                end = last
+            else:
+                end += len(closing_tag)
+
+            ranges.append((start, end))
+            start = end
+
+    return prolog, ranges
+
+# Worker for parse_nation_data_parallel: parse one byte range of the decompressed dump, wrapped in the dump's own prolog so that it is a complete document.
+def parse_nation_range(task: tuple[str, bytes, int, int]) -> list[tuple]:
+    filename, prolog, start, end = task
+
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    return list(parse_nation_data(io.BytesIO(prolog + data + b"</NATIONS>")))
+
+# Parse a decompressed nations.xml across several worker processes, yielding one batch of rows per byte range.
+# Batches are yielded in file order, so the rows come out in exactly the same order as with parse_nation_data.
+def parse_nation_data_parallel(filename: str, jobs: int) -> Iterator[list[tuple]]:
+    prolog, ranges = split_nation_data(filename)
+    tasks = [(filename, prolog, start, end) for start, end in ranges]
+
+    with multiprocessing.Pool(jobs) as pool:
+        yield from pool.imap(parse_nation_range, tasks)
+
+# Read-only binary stream fed by a background thread, so that downloading the next chunks overlaps with decompressing and parsing the current one.
+class PrefetchReader(io.RawIOBase):
+    def __init__(self, chunks: Iterable[bytes], depth: int = 64):
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.current = memoryview(b"")
+        self.finished = False
 
-    nation_data = []
+        self.thread = threading.Thread(target=self.fill, args=(chunks,), daemon=True)
+        self.thread.start()
 
-    nations = root.findall("./NATION")
+    def fill(self, chunks: Iterable[bytes]):
+        try:
+            for chunk in chunks:
+                if self.stopped.is_set():
+                    return
+                self.queue.put(chunk)
+        except Exception as e:
+            self.queue.put(e)
+            return
 
-    for nation in nations:
-        canon_name = nation.find("NAME").text
-        api_name = normalizeNationName(canon_name)
-        region = normalizeNationName(nation.find("REGION").text)
-        wa = False
-        if nation.find("UNSTATUS").text == "WA Member":
-            wa = True
-        lastlogin = int(nation.find("LASTLOGIN").text)
+        self.queue.put(None)
 
-        nation_data.append((canon_name, api_name, region, wa, lastlogin))
+    def readable(self):
+        return True
 
-    return nation_data
+    def readinto(self, buffer) -> int:
+        while len(self.current) == 0:
+            if self.finished:
+                return 0
+
+            item = self.queue.get()
+            if item is None:
+                self.finished = True
+                return 0
+            if isinstance(item, Exception):
+                self.finished = True
+                raise item
+
+            self.current = memoryview(item)
+
+        size = min(len(buffer), len(self.current))
+        buffer[:size] = self.current[:size]
+        self.current = self.current[size:]
+        return size
+
+    def close(self):
+        self.stopped.set()
+
+        # Unblock the producer thread if it is waiting on a full queue.
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+        super().close()
+
+# Request the data dump, to be parsed on the fly with stream_nation_data_dump.
+def request_nation_data_dump(nation: str, url: str = DUMP_URL) -> requests.Response:
+    headers = dump_request_headers(nation)
+
+    print(f"Streaming data dump from {url}")
+    print(f"Headers = {headers}")
+
+    r = requests.get(url, headers=headers, stream=True)
+    r.raise_for_status()
+    return r
+
+# Parse the data dump on the fly, without ever storing it on disk: HTTP stream -> gzip decompressor -> XML parser.
+# The gzip checksum is verified once the end of the dump is reached.
+def stream_nation_data_dump(r: requests.Response) -> Iterator[tuple]:
+    with PrefetchReader(r.iter_content(chunk_size=NETWORK_CHUNK_SIZE)) as raw:
+        with gzip.GzipFile(fileobj=io.BufferedReader(raw)) as f:
+            yield from parse_nation_data(f)
+
+# Insert nation rows in bounded batches, so that at most batch_size rows are held in memory at any point.
+def insert_nation_data(cursor: sqlite3.Cursor, nation_data: Iterable[tuple], batch_size: int = BATCH_SIZE, table: str = "nations") -> int:
+    count = 0
+    nation_data = iter(nation_data)
+
+    while True:
+        batch = list(itertools.islice(nation_data, batch_size))
+        if not batch:
+            break
+
+        cursor.executemany(f"INSERT OR IGNORE INTO {table} VALUES(?, ?, ?, ?, ?)", batch)
+        count += len(batch)
+
+    return count
+
+def create_nations_table(cursor: sqlite3.Cursor, table: str = "nations") -> None:
+    cursor.execute(f"""CREATE TABLE {table}(
+        canon_name TEXT NOT NULL,
+        api_name TEXT NOT NULL PRIMARY KEY,
+        region TEXT NOT NULL,
+        wa INTEGER NOT NULL,
+        lastlogin INTEGER NOT NULL
+    ) WITHOUT ROWID""")
+
+def create_dump_schema(cursor: sqlite3.Cursor) -> None:
+    create_nations_table(cursor)
+
+# The schema version is only written once the whole dump has been loaded and committed, so that a database left behind by an interrupted
+# download or parse has no version, and is rebuilt by the next run instead of being used.
+def mark_dump_complete(cursor: sqlite3.Cursor) -> None:
+    cursor.execute(f"PRAGMA user_version = {DUMP_SCHEMA_VERSION}")
+
+# Secondary indexes are only created once the table is filled, which is much cheaper than maintaining them during the bulk insert.
+def create_dump_indexes(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("CREATE INDEX nations_region ON nations(region)")
+
+# Trade durability for speed while loading the dump: if the process dies halfway through, the database is rebuilt on the next run anyway.
+def set_bulk_load_pragmas(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("PRAGMA journal_mode = OFF")
+    cursor.execute("PRAGMA synchronous = OFF")
+    cursor.execute("PRAGMA cache_size = -262144") # 256 MiB
+    cursor.execute("PRAGMA temp_store = MEMORY")
+
+def reset_bulk_load_pragmas(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("PRAGMA journal_mode = DELETE")
+    cursor.execute("PRAGMA synchronous = FULL")
+
+def dump_schema_version(path: str) -> int:
+    con = sqlite3.connect(path)
+    try:
+        return con.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        con.close()
+
+# Download the dump and insert all of it into the given table, parsing it with parse_jobs processes. Returns the number of nations
+# inserted and the metadata of the dump.
+def insert_dump(cursor: sqlite3.Cursor, ua: str, stream: bool, parse_jobs: int = 1, table: str = "nations", url: str = DUMP_URL) -> tuple[int, DumpMetadata]:
+    count = 0
+
+    if stream:
+        with request_nation_data_dump(ua, url) as r:
+            metadata = DumpMetadata.fromResponse(r)
+            count += insert_nation_data(cursor, stream_nation_data_dump(r), table=table)
+    elif parse_jobs > 1:
+        metadata = download_nation_data_dump(ua, DUMP_FILE, url)
+        decompress_nation_data_dump(DUMP_FILE, "nations.xml")
+        os.remove(DUMP_FILE)
+
+        for batch in parse_nation_data_parallel("nations.xml", parse_jobs):
+            count += insert_nation_data(cursor, batch, table=table)
+
+        os.remove("nations.xml")
+    else:
+        metadata = download_nation_data_dump(ua, DUMP_FILE, url)
+        count += insert_nation_data(cursor, parse_nation_data(DUMP_FILE), table=table)
+        os.remove(DUMP_FILE)
+
+    return count, metadata
+
+# Download the dump and fill the (empty) database behind con with it.
+def fill_database(con: sqlite3.Connection, ua: str, stream: bool, parse_jobs: int = 1, url: str = DUMP_URL) -> None:
+    cursor = con.cursor()
+    set_bulk_load_pragmas(cursor)
+    create_dump_schema(cursor)
+
+    # All batches are inserted within a single transaction, committed once the whole dump has been read.
+    _, metadata = insert_dump(cursor, ua, stream, parse_jobs, url=url)
+    write_dump_metadata(cursor, metadata)
+
+    create_dump_indexes(cursor)
+    con.commit()
+
+    reset_bulk_load_pragmas(cursor)
+    cursor.execute("ANALYZE")
+    mark_dump_complete(cursor)
+
+@dataclass
+class DumpChanges:
+    inserted: int
+    updated: int
+    deleted: int
+
+# Bring an existing dump database up to date with a new dump, only touching the rows that changed:
+# new nations are inserted, nations whose name, region, WA status or last login changed are updated, and nations that ceased to exist are deleted.
+# The new dump is staged in a temporary table first, and all changes are applied in a single transaction.
+def refresh_database(con: sqlite3.Connection, ua: str, stream: bool, parse_jobs: int = 1, url: str = DUMP_URL) -> DumpChanges:
+    cursor = con.cursor()
+    cursor.execute("PRAGMA cache_size = -262144") # 256 MiB
+    cursor.execute("PRAGMA temp_store = MEMORY")
+
+    create_nations_table(cursor, "temp.new_nations")
+    _, metadata = insert_dump(cursor, ua, stream, parse_jobs, "temp.new_nations", url)
+
+    cursor.execute("DELETE FROM nations WHERE api_name NOT IN (SELECT api_name FROM temp.new_nations)")
+    deleted = cursor.rowcount
+
+    cursor.execute("""UPDATE nations SET canon_name = n.canon_name, region = n.region, wa = n.wa, lastlogin = n.lastlogin
+        FROM temp.new_nations n WHERE nations.api_name = n.api_name
+        AND (nations.canon_name != n.canon_name OR nations.region != n.region OR nations.wa != n.wa OR nations.lastlogin != n.lastlogin)""")
+    updated = cursor.rowcount
+
+    cursor.execute("INSERT INTO nations SELECT * FROM temp.new_nations WHERE api_name NOT IN (SELECT api_name FROM nations)")
+    inserted = cursor.rowcount
+
+    write_dump_metadata(cursor, metadata)
+    con.commit()
+
+    cursor.execute("DROP TABLE temp.new_nations")
+
+    changes = DumpChanges(inserted, updated, deleted)
+    print(f"Refreshed {DUMP_DATABASE}: {changes.inserted} nations added, {changes.updated} updated, {changes.deleted} removed")
+
+    return changes
 
 # Generate the nation information database, using the provided nation name (user agent) to identify itself to NationStates.
-def generate_database(ua: str, download: bool = True) -> sqlite3.Connection:
-    if download:
-        if os.path.exists("nations.db"):
-            os.remove("nations.db")
+# If stream is set, the dump is inserted as it is being downloaded instead of being saved to nations.xml.gz first.
+# If memory is set, the database lives entirely in RAM: it is either built there or loaded from nations.db, and if backup is also set, a freshly built database is saved to nations.db as well.
+# If parse_jobs is greater than 1 (and stream is not set), the downloaded dump is decompressed to disk and parsed in parallel by that many processes.
+# If refresh is set (and download is not), an existing nations.db is updated in place with refresh_database instead of being rebuilt.
+# A new dump is only downloaded if it changed since the one nations.db was built from. The dump is downloaded from url.
+# Returns the connection, whether nations.db on disk is complete and holds the same dump (so that other processes can open it), and whether
+# the database was built or refreshed from a new dump by this call (so that anything derived from an older one, like the snapshot, is rebuilt).
+def generate_database(ua: str, download: bool = True, stream: bool = False, memory: bool = False, backup: bool = False, parse_jobs: int = 1, refresh: bool = False,
+        url: str = DUMP_URL) -> tuple[sqlite3.Connection, bool, bool]:
+    if (download or refresh) and os.path.exists(DUMP_DATABASE) and dump_schema_version(DUMP_DATABASE) == DUMP_SCHEMA_VERSION:
+        metadata = read_dump_metadata(DUMP_DATABASE)
+        if metadata and dump_unchanged(ua, metadata, url):
+            print(f"The data dump hasn't changed since {DUMP_DATABASE} was built, reusing it")
+            download = refresh = False
+
+    if not download:
+        if not os.path.exists(DUMP_DATABASE):
+            print(f"{DUMP_DATABASE} does not exist, downloading a new data dump")
+            download = True
+        elif dump_schema_version(DUMP_DATABASE) != DUMP_SCHEMA_VERSION:
+            print(f"{DUMP_DATABASE} is incomplete or was created by an older version of Moonlark, rebuilding it")
+            download = True
+
+    updated = download or refresh
+
+    if refresh and not download:
+        con = sqlite3.connect(DUMP_DATABASE)
+        refresh_database(con, ua, stream, parse_jobs, url)
+
+        if not memory:
+            return con, True, updated
+
+        con.close()
+
+    if not memory:
+        if download and os.path.exists(DUMP_DATABASE):
+            os.remove(DUMP_DATABASE)
+
+        con = sqlite3.connect(DUMP_DATABASE)
+        if download:
+            fill_database(con, ua, stream, parse_jobs, url)
+
+        return con, True, updated
+
+    con = sqlite3.connect(":memory:")
 
-    con = sqlite3.connect("nations.db")
+    if not download:
+        disk = sqlite3.connect(DUMP_DATABASE)
+        disk.backup(con)
+        disk.close()
+        return con, True, updated
 
-    if download:
-        cursor = con.cursor()
-        cursor.execute("CREATE TABLE nations(canon_name, api_name, region, wa, lastlogin)")
+    fill_database(con, ua, stream, parse_jobs, url)
 
-        download_nation_data_dump(ua)
-        nation_data = parse_nation_data("nations.xml")
+    if backup:
+        if os.path.exists(DUMP_DATABASE):
+            os.remove(DUMP_DATABASE)
 
-        cursor.executemany("INSERT INTO nations VALUES(?, ?, ?, ?, ?)", nation_data)
-        con.commit()
+        disk = sqlite3.connect(DUMP_DATABASE)
+        con.backup(disk)
+        disk.close()
 
-    return con
\ No newline at end of file
+    return con, backup, updated
@@ -0,0 +1,63 @@
+import json
+from .classes import Recruit, TelegramTemplate, TimeRange, Stats
+
+# Decoder for the JSON files exported by masstgexport.user.js. The file is loaded with json.load, then checked against the expected schema,
+# so that a malformed export is reported with its file name instead of failing somewhere in the analytics.
+
+# Fields of an export, with the type each of them must have. Optional fields may be missing from older exports.
+REQUIRED_FIELDS = {"tgid": int, "type": str, "nation": str, "createdAt": int, "generatedAt": int, "delivered": int, "recruitCount": int}
+OPTIONAL_FIELDS = {"category": str, "readCount": int}
+RECRUIT_FIELDS = {"name": str, "cte": bool, "timestamp": int}
+
+class TemplateFormatError(ValueError):
+    pass
+
+def check_type(value, expected: type) -> bool:
+    # bool is a subclass of int, but true/false are never valid where a number is expected.
+    return type(value) is expected
+
+# Decode and validate an export. Recipients are left as the list of names in the file, to be interned by the caller.
+def decode_template(path: str) -> TelegramTemplate:
+    with open(path, "r") as f:
+        try:
+            fields = json.load(f)
+        except json.JSONDecodeError as e:
+            raise TemplateFormatError(f"{path}: {e}")
+
+    if not isinstance(fields, dict):
+        raise TemplateFormatError(f"{path}: expected an object")
+
+    for field, expected in REQUIRED_FIELDS.items():
+        if not check_type(fields.get(field), expected):
+            raise TemplateFormatError(f"{path}: field '{field}' is missing or not of type {expected.__name__}")
+
+    for field, expected in OPTIONAL_FIELDS.items():
+        if field in fields and not check_type(fields[field], expected):
+            raise TemplateFormatError(f"{path}: field '{field}' is not of type {expected.__name__}")
+
+    recipients = fields.get("recipients")
+    if not isinstance(recipients, list) or not all(type(name) is str for name in recipients):
+        raise TemplateFormatError(f"{path}: recipients are missing or not an array of str")
+
+    recruits = fields.get("recruits")
+    if not isinstance(recruits, list) or not all(type(recruit) is dict for recruit in recruits):
+        raise TemplateFormatError(f"{path}: recruits are missing or not an array of objects")
+
+    template = TelegramTemplate()
+    template.tgid = fields["tgid"]
+    template.type = fields["type"]
+    template.nation = fields["nation"]
+    template.category = fields.get("category", "Uncategorized")
+    template.timeRange = TimeRange(fields["createdAt"], fields["generatedAt"])
+    template.stats = Stats(fields["delivered"], fields.get("readCount", 0), fields["recruitCount"])
+    template.recipients = recipients
+    template.recruits = {}
+
+    for recruit in recruits:
+        for field, expected in RECRUIT_FIELDS.items():
+            if not check_type(recruit.get(field), expected):
+                raise TemplateFormatError(f"{path}: recruit field '{field}' is missing or not of type {expected.__name__}")
+
+        template.recruits[recruit["name"]] = Recruit(recruit["cte"], recruit["timestamp"], recruit["name"])
+
+    return template
@@ -1,6 +1,9 @@
 import datetime
 
 def renderRate(total: int, count: int):
+    if total == 0:
+        return "N/A"
+
     rate = (count / total) * 100
     return f"{round(rate, 2)}%"
 
@@ -9,9 +12,6 @@ def renderDate(timestamp: int):
 
     return local_date.strftime("%B %d, %Y")
 
-def items(view: dict):
-    return view.items()
-
 def normalizeNationName(name: str):
     return name.lower().replace(" ", "_")
 
@@ -27,14 +27,8 @@ def methodName(method: str):
 def sortByHighest(view: dict):
     return sorted(view.items(), key=lambda item: item[1], reverse=True)
 
-def sortTop(view: dict):
-    return sortByHighest(view)[:5]
-
 def sortStatsByHighest(view: dict):
     return sorted(view.items(), key=lambda item: item[1].delivered, reverse=True)
 
-def sortStatsTop(view: dict):
-    return sortStatsByHighest(view)[:5]
-
 def displayNumberWithCommas(number: int):
     return f'{number:,}'
\ No newline at end of file
@@ -0,0 +1,103 @@
+import sqlite3, itertools
+from .classes import Recruit, Retention
+
+HISTORY_DATABASE = "history.db"
+
+# Days after recruitment at which retention is measured by default.
+RETENTION_DAYS = [1, 7, 30, 90]
+
+DAY = 60 * 60 * 24
+
+# History of every nation across all the dumps that have been ingested, stored as intervals rather than full copies:
+# a row (api_name, region, wa, since, until) means the nation was seen with that region and WA status from the dump taken at since
+# up to the first dump, taken at until, in which it was different (or gone). until is NULL for the state seen in the latest dump.
+class NationHistory:
+    def __init__(self, path: str = HISTORY_DATABASE):
+        self.con = sqlite3.connect(path)
+
+        cursor = self.con.cursor()
+        cursor.execute("CREATE TABLE IF NOT EXISTS snapshots(taken INTEGER NOT NULL PRIMARY KEY)")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS intervals(
+            api_name TEXT NOT NULL,
+            region TEXT NOT NULL,
+            wa INTEGER NOT NULL,
+            since INTEGER NOT NULL,
+            until INTEGER,
+            PRIMARY KEY (api_name, since)
+        ) WITHOUT ROWID""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS intervals_open ON intervals(api_name) WHERE until IS NULL")
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+    def latest_snapshot(self) -> int | None:
+        return self.con.execute("SELECT MAX(taken) FROM snapshots").fetchone()[0]
+
+    # Record the dump in the given database as a new snapshot, only writing the nations whose region or WA status changed since the last one.
+    # The time of a dump is taken to be its most recent login, which identifies it without any extra metadata; a dump that is not newer than the latest snapshot is skipped.
+    def ingest(self, dump: sqlite3.Connection, batch_size: int = 10000) -> bool:
+        taken = dump.execute("SELECT MAX(lastlogin) FROM nations").fetchone()[0]
+        latest = self.latest_snapshot()
+
+        if taken is None or (latest is not None and taken <= latest):
+            return False
+
+        cursor = self.con.cursor()
+        cursor.execute("CREATE TEMP TABLE current(api_name TEXT NOT NULL PRIMARY KEY, region TEXT NOT NULL, wa INTEGER NOT NULL) WITHOUT ROWID")
+
+        rows = dump.execute("SELECT api_name, region, wa FROM nations")
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            cursor.executemany("INSERT INTO temp.current VALUES(?, ?, ?)", batch)
+
+        cursor.execute("""UPDATE intervals SET until = ? WHERE until IS NULL AND NOT EXISTS (
+            SELECT 1 FROM temp.current c WHERE c.api_name = intervals.api_name AND c.region = intervals.region AND c.wa = intervals.wa)""", [taken])
+        closed = cursor.rowcount
+
+        cursor.execute("""INSERT INTO intervals SELECT c.api_name, c.region, c.wa, ?, NULL FROM temp.current c
+            WHERE NOT EXISTS (SELECT 1 FROM intervals i WHERE i.api_name = c.api_name AND i.until IS NULL)""", [taken])
+        opened = cursor.rowcount
+
+        cursor.execute("INSERT INTO snapshots VALUES(?)", [taken])
+        self.con.commit()
+
+        cursor.execute("DROP TABLE temp.current")
+
+        print(f"Recorded dump in history: {opened} nations changed, {closed} intervals closed")
+        return True
+
+    # For each number of days, count how many of the given recruits were in the region that many days after being recruited,
+    # out of those for which it can be told (the history covers that point in time for that nation).
+    def retention(self, recruits: list[Recruit], region: str, days: list[int] = RETENTION_DAYS) -> dict[str, Retention]:
+        result = {str(offset): Retention(offset, 0, 0) for offset in days}
+
+        latest = self.latest_snapshot()
+        if latest is None or len(recruits) == 0:
+            return result
+
+        cursor = self.con.cursor()
+        cursor.execute("CREATE TEMP TABLE retention_queries(api_name TEXT NOT NULL, days INTEGER NOT NULL, at INTEGER NOT NULL)")
+        cursor.executemany("INSERT INTO temp.retention_queries VALUES(?, ?, ?)",
+            ((recruit.name, offset, recruit.recruitedAt + offset * DAY) for offset in days for recruit in recruits))
+
+        cursor.execute("""SELECT q.days, q.at,
+            (SELECT MIN(i.since) FROM intervals i WHERE i.api_name = q.api_name),
+            (SELECT i.region FROM intervals i WHERE i.api_name = q.api_name AND i.since <= q.at AND (i.until IS NULL OR i.until > q.at)
+                ORDER BY i.since DESC LIMIT 1)
+            FROM temp.retention_queries q""")
+
+        for offset, at, first_seen, seen_region in cursor.fetchall():
+            if first_seen is None or at < first_seen or at > latest:
+                continue
+
+            retention = result[str(offset)]
+            retention.measured += 1
+            if seen_region == region:
+                retention.retained += 1
+
+        cursor.execute("DROP TABLE temp.retention_queries")
+
+        return result
@@ -0,0 +1,104 @@
+import os, marshal, hashlib
+from .classes import Recruit, TelegramTemplate, TimeRange, Stats
+from .registry import NationRegistry, unique_ids
+
+# Name of the manifest file kept in the telegram template folder.
+MANIFEST_FILE = ".moonlark-manifest"
+
+# Bump this whenever the layout of cached templates changes, so that old manifests are discarded.
+MANIFEST_VERSION = 1
+
+def hash_file(path: str) -> bytes:
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+
+    return digest.digest()
+
+# Templates are cached as plain tuples of builtin types, which marshal stores compactly and loads much faster than JSON.
+# Nation IDs only mean something to the registry of the current run, so recipients are stored by name.
+def pack_template(template: TelegramTemplate, registry: NationRegistry) -> tuple:
+    recruits = [(recruit.cte, recruit.recruitedAt, recruit.name) for recruit in template.recruits.values()]
+
+    return (template.tgid, template.type, template.nation, template.category, template.timeRange.start, template.timeRange.end,
+        template.stats.delivered, template.stats.readCount, template.stats.recruitCount, registry.names_of(template.recipients), recruits)
+
+def unpack_template(record: tuple, registry: NationRegistry) -> TelegramTemplate:
+    tgid, type, nation, category, start, end, delivered, readCount, recruitCount, recipients, recruits = record
+
+    template = TelegramTemplate()
+    template.tgid = tgid
+    template.type = type
+    template.nation = nation
+    template.category = category
+    template.timeRange = TimeRange(start, end)
+    template.stats = Stats(delivered, readCount, recruitCount)
+    template.recipients = unique_ids(registry.intern_all(recipients))
+    template.recruits = {}
+    for cte, recruitedAt, name in recruits:
+        name = registry.canonical(name)
+        template.recruits[name] = Recruit(cte, recruitedAt, name)
+
+    return template
+
+# Cache of parsed telegram templates, keyed by file path. An entry is reused as long as the file has the same size and
+# modification time, or, if those changed, the same content hash; anything else is parsed again.
+class TemplateManifest:
+    def __init__(self, folder: str, registry: NationRegistry):
+        self.registry = registry
+        self.path = os.path.join(folder, MANIFEST_FILE)
+        self.entries: dict[str, tuple] = {}
+        self.seen: set[str] = set()
+        self.changed = False
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "rb") as f:
+                    data = marshal.load(f)
+                if data.get("version") == MANIFEST_VERSION:
+                    self.entries = data["entries"]
+            except (EOFError, ValueError, TypeError, AttributeError):
+                print(f"Ignoring unreadable template manifest {self.path}")
+
+    # Return the template stored in the given file, parsing it with parse(path) only if the cached copy is missing or outdated.
+    def load(self, path: str, parse) -> TelegramTemplate:
+        self.seen.add(path)
+
+        stat = os.stat(path)
+        entry = self.entries.get(path)
+
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return unpack_template(entry[3], self.registry)
+
+        digest = hash_file(path)
+        self.changed = True
+
+        if entry and entry[2] == digest:
+            self.entries[path] = (stat.st_size, stat.st_mtime_ns, digest, entry[3])
+            return unpack_template(entry[3], self.registry)
+
+        template = parse(path)
+        self.entries[path] = (stat.st_size, stat.st_mtime_ns, digest, pack_template(template, self.registry))
+
+        return template
+
+    # Content hash of a file loaded with load().
+    def digest(self, path: str) -> bytes:
+        return self.entries[path][2]
+
+    # Write the manifest back if anything changed, dropping entries for files that no longer exist.
+    def save(self) -> None:
+        removed = [path for path in self.entries.keys() if path not in self.seen]
+        for path in removed:
+            del self.entries[path]
+
+        if not self.changed and not removed:
+            return
+
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            marshal.dump({"version": MANIFEST_VERSION, "entries": self.entries}, f)
+
+        os.replace(temporary_path, self.path)
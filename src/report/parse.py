@@ -1,24 +1,23 @@
-from .classes import Recruit, Telegram, TelegramTemplate, TimeRange, Stats
+from .classes import Telegram, TimeRange, Stats
+from .manifest import TemplateManifest, hash_file
+from .decode import decode_template
+from .registry import NationRegistry, unique_ids
 import json, os
 
+# Load a whole export with the standard JSON decoder, without validating or converting it (see decode_template).
 def import_raw_template_data(path: str):
     with open(path, "r") as tgdata:
         return json.load(tgdata)
     
-def import_template_data(path: str):
-    tgdata = import_raw_template_data(path)
-
-    template = TelegramTemplate()
-    template.tgid = tgdata["tgid"]
-    template.type = tgdata["type"]
-    template.nation = tgdata["nation"]
-    template.category = tgdata.get("category", "Uncategorized")
-    template.timeRange = TimeRange(tgdata["createdAt"], tgdata["generatedAt"])
-    template.stats = Stats(tgdata["delivered"], tgdata.get("readCount", 0), tgdata["recruitCount"])
-    template.recipients = tgdata["recipients"]
-    template.recruits = {}
-    for recruit in tgdata["recruits"]:
-        template.recruits[recruit["name"]] = Recruit(recruit["cte"], recruit["timestamp"], recruit["name"])
+# Decode an export, interning every nation it mentions. Recipients are stored as a deduplicated array of nation IDs, and recruit names
+# are replaced by the registry's copy, so that a nation's name is only ever kept once in memory.
+def import_template_data(path: str, registry: NationRegistry):
+    template = decode_template(path)
+    template.recipients = unique_ids(registry.intern_all(template.recipients))
+
+    for recruit in template.recruits.values():
+        recruit.name = registry.canonical(recruit.name)
+    template.recruits = {recruit.name: recruit for recruit in template.recruits.values()}
 
     return template
 
@@ -27,7 +26,7 @@ def create_empty_telegram(category_name: str) -> Telegram:
     telegram.category = category_name
     telegram.stats = Stats.empty()
     telegram.timeRange = TimeRange.default()
-    telegram.recipients = []
+    telegram.recipients = unique_ids()
     telegram.recruits = {}
     telegram.templates = []
     telegram.methods = {}
@@ -35,25 +34,36 @@ def create_empty_telegram(category_name: str) -> Telegram:
 
     return telegram
 
-def parse_template_folder(path: str) -> dict[str, Telegram]:
+# Parse every telegram template export in the given folder and group them by category.
+# Nations are interned in registry; recipients of each template and category are deduplicated arrays of IDs into it.
+# Unless use_manifest is False, parsed templates are cached in a manifest in that folder, so that only new or modified exports get parsed.
+# If digests is given, the content hash of every template file of each category is added to it, by category.
+def parse_template_folder(path: str, registry: NationRegistry, use_manifest: bool = True, digests: dict[str, list[bytes]] | None = None) -> dict[str, Telegram]:
     telegrams: dict[str, Telegram] = {}
+    manifest = TemplateManifest(path, registry) if use_manifest else None
+    recipients: dict[str, list] = {}
 
     for entry in os.scandir(path):
         if entry.is_file() and entry.name.endswith(".json"):
-            template = import_template_data(entry.path)
+            if manifest:
+                template = manifest.load(entry.path, lambda path: import_template_data(path, registry))
+            else:
+                template = import_template_data(entry.path, registry)
 
             if template.category not in telegrams.keys():
                 telegrams[template.category] = create_empty_telegram(template.category)
 
             telegram = telegrams[template.category]
 
-            telegram.stats.add(template.stats)
+            if digests is not None:
+                digests.setdefault(template.category, []).append(manifest.digest(entry.path) if manifest else hash_file(entry.path))
+
+            telegram.stats.merge(template.stats)
 
-            telegram.recipients += template.recipients
+            recipients.setdefault(template.category, []).append(template.recipients)
             telegram.recruits.update(template.recruits)
 
-            telegram.timeRange.try_add_start(template.timeRange.start)
-            telegram.timeRange.try_add_end(template.timeRange.end)
+            telegram.timeRange.merge(template.timeRange)
 
             if template.type not in telegram.methods.keys():
                 telegram.methods[template.type] = Stats.empty()
@@ -61,9 +71,15 @@ def parse_template_folder(path: str) -> dict[str, Telegram]:
             if template.nation not in telegram.nations.keys():
                 telegram.nations[template.nation] = Stats.empty()
 
-            telegram.methods[template.type].add(template.stats)
-            telegram.nations[template.nation].add(template.stats)
+            telegram.methods[template.type].merge(template.stats)
+            telegram.nations[template.nation].merge(template.stats)
 
             telegram.templates.append(template)
 
+    for category, telegram in telegrams.items():
+        telegram.recipients = unique_ids(*recipients[category])
+
+    if manifest:
+        manifest.save()
+
     return telegrams
\ No newline at end of file
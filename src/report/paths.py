@@ -0,0 +1,3 @@
+# Files in the working directory that several modules open. Kept free of other imports, so that importing them costs nothing.
+
+DUMP_DATABASE = "nations.db"
@@ -0,0 +1,85 @@
+import os, sys, csv, json, time, cProfile
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: # Not available on Windows, where peak memory use isn't recorded.
+    resource = None
+
+# Peak memory use is the highest resident set size of the process (and of its largest finished child process) at any point up to the end
+# of the stage, including earlier stages, rather than that of the stage itself.
+PROFILE_FIELDS = ["stage", "name", "category", "wall_seconds", "cpu_seconds", "peak_rss_so_far_bytes", "children_peak_rss_so_far_bytes", "items"]
+
+# Highest resident set size reached so far by this process and by its largest finished child process (e.g. of worker pools), in bytes.
+def peak_rss() -> tuple[int | None, int | None]:
+    if resource is None:
+        return None, None
+
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+    unit = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit
+
+# CPU time used so far by this process and its finished child processes.
+def cpu_time() -> float:
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+# Run function(*args) in a worker process, returning its result and a record of its wall time, CPU time and peak memory use so far
+# (of the worker), to be added to the Profiler of the main process with Profiler.add.
+def measure(stage: str, name: str, category: str | None, function, *args) -> tuple:
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = function(*args)
+
+    record = {"stage": stage, "name": name, "category": category, "items": None, "wall_seconds": round(time.perf_counter() - wall, 6),
+        "cpu_seconds": round(time.process_time() - cpu, 6), "peak_rss_so_far_bytes": peak_rss()[0], "children_peak_rss_so_far_bytes": None}
+    return result, record
+
+# Records the wall time, CPU time, peak memory use so far and number of items processed of each stage of a report (and of each category
+# within a stage). If cprofile_folder is set, every stage is also run under cProfile, and its statistics saved in that folder.
+class Profiler:
+    def __init__(self, cprofile_folder: str | None = None):
+        self.records: list[dict] = []
+        self.cprofile_folder = cprofile_folder
+
+    # Profile the body of a with statement. The yielded record can be given the number of items the stage processed, as record["items"].
+    @contextmanager
+    def stage(self, stage: str, name: str, category: str | None = None):
+        record = {"stage": stage, "name": name, "category": category, "items": None}
+
+        profile = None
+        if self.cprofile_folder:
+            profile = cProfile.Profile()
+
+        wall, cpu = time.perf_counter(), cpu_time()
+        if profile:
+            profile.enable()
+
+        try:
+            yield record
+        finally:
+            if profile:
+                profile.disable()
+
+            record["wall_seconds"] = round(time.perf_counter() - wall, 6)
+            record["cpu_seconds"] = round(cpu_time() - cpu, 6)
+            record["peak_rss_so_far_bytes"], record["children_peak_rss_so_far_bytes"] = peak_rss()
+            self.records.append(record)
+
+            if profile:
+                os.makedirs(self.cprofile_folder, exist_ok=True)
+                suffix = f"-{category}" if category is not None else ""
+                profile.dump_stats(os.path.join(self.cprofile_folder, f"{stage}-{name}{suffix}.prof".replace(" ", "_")))
+
+    # Add a record made by measure in a worker process.
+    def add(self, record: dict):
+        self.records.append(record)
+
+    # Save the records as profile.json and profile.csv in folder.
+    def write(self, folder: str):
+        with open(os.path.join(folder, "profile.json"), "w") as output:
+            json.dump([{field: record[field] for field in PROFILE_FIELDS} for record in self.records], output, indent=4)
+
+        with open(os.path.join(folder, "profile.csv"), "w", newline="") as output:
+            writer = csv.DictWriter(output, PROFILE_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.records)
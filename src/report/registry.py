@@ -0,0 +1,37 @@
+from typing import Iterable
+import numpy as np
+
+# Registry of every nation name seen while parsing telegram templates. Each api_name is stored once and given a small integer ID,
+# so that recipients can be kept as compact ID arrays shared by all templates and categories instead of lists of (repeated) strings.
+class NationRegistry:
+    def __init__(self):
+        self.names: list[str] = []
+        self.ids: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def intern(self, name: str) -> int:
+        nation_id = self.ids.get(name)
+        if nation_id is None:
+            nation_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return nation_id
+
+    # IDs of the given names, registering the ones that are new. Duplicates are kept; see unique_ids.
+    def intern_all(self, names: Iterable[str]) -> np.ndarray:
+        return np.fromiter((self.intern(name) for name in names), dtype=np.int32)
+
+    # The registered (shared) string object for the given name.
+    def canonical(self, name: str) -> str:
+        return self.names[self.intern(name)]
+
+    def names_of(self, ids: np.ndarray) -> list[str]:
+        names = self.names
+        return [names[nation_id] for nation_id in ids.tolist()]
+
+# Deduplicate arrays of nation IDs into one, keeping the order in which each nation first appears.
+def unique_ids(*arrays: np.ndarray) -> np.ndarray:
+    ids = np.concatenate(arrays) if arrays else np.empty(0, dtype=np.int32)
+    _, first = np.unique(ids, return_index=True)
+    return ids[np.sort(first)]
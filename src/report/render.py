@@ -0,0 +1,77 @@
+import os, json, multiprocessing
+import jinja2
+from .classes import Telegram
+from .view import IndexView, ComparisonView, ShardedListView, build_telegram_view, build_telegram_shards
+
+TEMPLATE_FOLDER = "templates"
+
+# Compiled templates are cached here, so that later runs skip compiling them as long as the templates don't change.
+BYTECODE_CACHE = os.path.join(TEMPLATE_FOLDER, ".cache")
+
+def create_environment() -> jinja2.Environment:
+    os.makedirs(BYTECODE_CACHE, exist_ok=True)
+    return jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATE_FOLDER), bytecode_cache=jinja2.FileSystemBytecodeCache(BYTECODE_CACHE))
+
+# Render a template straight into a file, one chunk at a time, instead of building the whole page as a string first.
+def render_to_file(template: jinja2.Template, path: str, **context):
+    with open(path, "w") as output:
+        output.writelines(template.generate(**context))
+
+# Write rows as pages of page_size rows each, to {folder}/{category}/{name}-{page}.json.
+def write_shards(folder: str, category: str, name: str, title: str, rows: list[dict], page_size: int) -> ShardedListView:
+    os.makedirs(f"{folder}/{category}", exist_ok=True)
+    pages = -(-len(rows) // page_size)
+
+    for page in range(pages):
+        with open(f"{folder}/{category}/{name}-{page}.json", "w") as output:
+            json.dump(rows[page * page_size:(page + 1) * page_size], output, separators=(",", ":"))
+
+    return ShardedListView(name, title, len(rows), pages, page_size)
+
+# Render the page of a category. With a page_size, its large lists are written as JSON shards of that many rows that the page loads on
+# demand, instead of being inlined. The view and shard rows are only built here, so that only one category's are held at a time.
+def render_telegram(env: jinja2.Environment, folder: str, telegram: Telegram, canon_names: dict[str, str], page_size: int = 0):
+    view = build_telegram_view(telegram, canon_names)
+
+    sharded_lists = None
+    if page_size > 0:
+        sharded_lists = [write_shards(folder, view.category, name, title, rows, page_size) for name, (title, rows) in build_telegram_shards(telegram, canon_names).items()]
+
+    render_to_file(env.get_template("telegram.html.jinja"), f"{folder}/{view.category}.html", telegram=view, shards=sharded_lists)
+
+def render_index(env: jinja2.Environment, folder: str, view: IndexView):
+    render_to_file(env.get_template("index.html.jinja"), f"{folder}/index.html", report=view)
+
+def render_comparison(folder: str, view: ComparisonView):
+    render_to_file(create_environment().get_template("comparison.html.jinja"), f"{folder}/index.html", report=view)
+
+# Jinja environment and canonical names of each worker process of render_report, set up once by init_render_worker.
+worker_env: jinja2.Environment | None = None
+worker_canon_names: dict[str, str] | None = None
+
+def init_render_worker(canon_names: dict[str, str]):
+    global worker_env, worker_canon_names
+    worker_env = create_environment()
+    worker_canon_names = canon_names
+
+def render_telegram_task(task: tuple):
+    folder, telegram, page_size = task
+    render_telegram(worker_env, folder, telegram, worker_canon_names, page_size)
+
+# Render the page of every category and the index into folder. With a page_size, the lists of each category page are sharded.
+# With more than one job, category pages are rendered by a pool of jobs processes while this process renders the index.
+def render_report(folder: str, telegrams: list[Telegram], canon_names: dict[str, str], index_view: IndexView, jobs: int = 1, page_size: int = 0):
+    env = create_environment()
+
+    if jobs <= 1 or len(telegrams) <= 1:
+        for telegram in telegrams:
+            render_telegram(env, folder, telegram, canon_names, page_size)
+        render_index(env, folder, index_view)
+        return
+
+    tasks = [(folder, telegram, page_size) for telegram in telegrams]
+
+    with multiprocessing.Pool(min(jobs, len(telegrams)), initializer=init_render_worker, initargs=(canon_names,)) as pool:
+        result = pool.map_async(render_telegram_task, tasks, chunksize=1)
+        render_index(env, folder, index_view)
+        result.get()
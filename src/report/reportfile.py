@@ -0,0 +1,253 @@
+import os, json, mmap, zlib
+import numpy as np
+from .classes import Activity, Analytics, Cohorts, Recruit, RegionCounts, Retention, Stats, Telegram, TelegramTemplate, TimeRange
+from .registry import NationRegistry
+
+# Compact report container, written by genreport instead of one large indented JSON file.
+#
+# The file is a sequence of zlib-compressed sections followed by an index: small JSON sections hold the aggregates shown in the report,
+# while recipients, recruits and faithful nations are stored as columnar arrays of nation IDs into a single table of nation names.
+# Sections are written as soon as they are ready and the index is only written at the end, so a report can be streamed to disk one
+# category at a time. A reader only parses the index when opening the file and decompresses sections when they are first used.
+#
+#   magic | section... | index (JSON) | index offset (8 bytes, little-endian) | magic
+
+REPORT_FILE = "report.mlr"
+
+REPORT_MAGIC = b"MLREPORT"
+
+# Bump this whenever the layout of the report file changes.
+REPORT_VERSION = 1
+
+FOOTER_SIZE = 8 + len(REPORT_MAGIC)
+
+def is_report_file(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(REPORT_MAGIC)) == REPORT_MAGIC
+
+def to_json(value) -> bytes:
+    return json.dumps(value, default=vars, separators=(",", ":")).encode("utf-8")
+
+def analytics_summary(analytics: Analytics) -> dict:
+    return {"stats": analytics.stats, "traitor_destinations": analytics.traitor_destinations, "uninterested_destinations": analytics.uninterested_destinations,
+        "timeRange": analytics.timeRange, "retention": analytics.retention, "cohorts": analytics.cohorts,
+        "activity": analytics.activity}
+
+def template_summary(template: TelegramTemplate) -> dict:
+    return {"tgid": template.tgid, "type": template.type, "nation": template.nation, "category": template.category, "timeRange": template.timeRange, "stats": template.stats}
+
+class ReportWriter:
+    def __init__(self, path: str, registry: NationRegistry):
+        self.path = path
+        self.registry = registry
+        self.sections: dict[str, dict] = {}
+        self.categories: list[str] = []
+
+        self.temporary_path = path + ".tmp"
+        self.file = open(self.temporary_path, "wb")
+        self.file.write(REPORT_MAGIC)
+
+    def write_section(self, name: str, data: bytes, **info):
+        compressed = zlib.compress(data)
+        self.sections[name] = {"offset": self.file.tell(), "length": len(compressed), **info}
+        self.file.write(compressed)
+
+    def write_json(self, name: str, value):
+        self.write_section(name, to_json(value))
+
+    def write_array(self, name: str, array: np.ndarray):
+        self.write_section(name, array.tobytes(), dtype=array.dtype.str, count=len(array))
+
+    def write_recruits(self, name: str, recruits: list[Recruit]):
+        self.write_array(f"{name}.name", self.registry.intern_all(recruit.name for recruit in recruits))
+        self.write_array(f"{name}.cte", np.fromiter((recruit.cte for recruit in recruits), dtype=bool, count=len(recruits)))
+        self.write_array(f"{name}.recruitedAt", np.fromiter((recruit.recruitedAt for recruit in recruits), dtype=np.int64, count=len(recruits)))
+
+    # Write offsets into a concatenated column, so that item i of the column is values[offsets[i]:offsets[i+1]].
+    def write_offsets(self, name: str, lengths: list[int]):
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        self.write_array(f"{name}.offsets", offsets)
+
+    # Write the complete data of one category (its analytics must already be generated).
+    def write_telegram(self, telegram: Telegram):
+        prefix = f"telegrams/{len(self.categories)}"
+        self.categories.append(telegram.category)
+
+        self.write_json(prefix, {"category": telegram.category, "stats": telegram.stats, "timeRange": telegram.timeRange, "methods": telegram.methods,
+            "nations": telegram.nations, "analytics": analytics_summary(telegram.analytics), "templates": [template_summary(template) for template in telegram.templates]})
+
+        self.write_recruits(f"{prefix}/faithful", telegram.analytics.faithful)
+        self.write_recruits(f"{prefix}/wa_faithful", telegram.analytics.wa_faithful)
+
+        self.write_array(f"{prefix}/recipients", telegram.recipients.astype(np.int32))
+        self.write_recruits(f"{prefix}/recruits", list(telegram.recruits.values()))
+
+        self.write_offsets(f"{prefix}/templates/recipients", [len(template.recipients) for template in telegram.templates])
+        self.write_array(f"{prefix}/templates/recipients", np.concatenate([template.recipients for template in telegram.templates] + [np.zeros(0, dtype=np.int32)]).astype(np.int32))
+
+        self.write_offsets(f"{prefix}/templates/recruits", [len(template.recruits) for template in telegram.templates])
+        self.write_recruits(f"{prefix}/templates/recruits", [recruit for template in telegram.templates for recruit in template.recruits.values()])
+
+    # Write the overall results and the nation table, then the index. The report is only moved into place once it is complete.
+    def close(self, analytics: Analytics, methods: dict[str, Stats], nations: dict[str, Stats], extra: dict | None = None):
+        self.write_json("report", {"version": REPORT_VERSION, "categories": self.categories, "methods": methods, "nations": nations,
+            "analytics": analytics_summary(analytics), **(extra or {})})
+
+        self.write_recruits("report/faithful", analytics.faithful)
+        self.write_recruits("report/wa_faithful", analytics.wa_faithful)
+
+        names = [name.encode("utf-8") for name in self.registry.names]
+        self.write_offsets("nations", [len(name) for name in names])
+        self.write_array("nations", np.frombuffer(b"".join(names), dtype=np.uint8))
+
+        index_offset = self.file.tell()
+        self.file.write(to_json({"version": REPORT_VERSION, "sections": self.sections}))
+        self.file.write(index_offset.to_bytes(8, "little"))
+        self.file.write(REPORT_MAGIC)
+        self.file.close()
+
+        os.replace(self.temporary_path, self.path)
+
+    # Discard an unfinished report. Does nothing once the report has been closed.
+    def abort(self):
+        if self.file.closed:
+            return
+
+        self.file.close()
+        os.remove(self.temporary_path)
+
+    # As a context manager, the report is aborted if an error (or an interruption) happens before it is closed.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is not None:
+            self.abort()
+
+def stats_from(src: dict) -> dict[str, Stats]:
+    return {k: Stats.fromJSON(v) for k, v in src.items()}
+
+# Read-only view of a report file. Sections are decompressed on first use and cached, so that rendering the HTML pages
+# only touches the aggregates, while recipient and recruit arrays are only read when the full report is loaded.
+class ReportReader:
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.cache = {}
+        self.names: list[str] | None = None
+
+        if self.map[:len(REPORT_MAGIC)] != REPORT_MAGIC or self.map[-len(REPORT_MAGIC):] != REPORT_MAGIC:
+            raise ValueError(f"{path} is not a Moonlark report")
+
+        index_offset = int.from_bytes(self.map[-FOOTER_SIZE:-len(REPORT_MAGIC)], "little")
+        index = json.loads(self.map[index_offset:-FOOTER_SIZE])
+
+        if index["version"] != REPORT_VERSION:
+            raise ValueError(f"{path} was created by an incompatible version of Moonlark")
+
+        self.sections = index["sections"]
+        self.report = self.json("report")
+        self.categories: list[str] = self.report["categories"]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def section(self, name: str) -> bytes:
+        section = self.sections[name]
+        return zlib.decompress(self.map[section["offset"]:section["offset"] + section["length"]])
+
+    def json(self, name: str):
+        if name not in self.cache:
+            self.cache[name] = json.loads(self.section(name))
+        return self.cache[name]
+
+    def array(self, name: str) -> np.ndarray:
+        section = self.sections[name]
+        return np.frombuffer(self.section(name), dtype=np.dtype(section["dtype"]), count=section["count"])
+
+    def nation_names(self) -> list[str]:
+        if self.names is None:
+            blob = self.array("nations").tobytes()
+            self.names = [blob[start:end].decode("utf-8") for start, end in self.offsets("nations")]
+        return self.names
+
+    def recruits(self, name: str) -> list[Recruit]:
+        names = self.nation_names()
+        return [Recruit(cte, recruitedAt, names[nation_id]) for nation_id, cte, recruitedAt in
+            zip(self.array(f"{name}.name").tolist(), self.array(f"{name}.cte").tolist(), self.array(f"{name}.recruitedAt").tolist())]
+
+    def offsets(self, name: str) -> list[tuple[int, int]]:
+        offsets = self.array(f"{name}.offsets").tolist()
+        return list(zip(offsets[:-1], offsets[1:]))
+
+    def nation_ids(self, name: str, registry: NationRegistry) -> np.ndarray:
+        names = self.nation_names()
+        return registry.intern_all(names[nation_id] for nation_id in self.array(name).tolist())
+
+    def analytics(self, src: dict, prefix: str) -> Analytics:
+        return Analytics(Stats.fromJSON(src["stats"]), self.recruits(f"{prefix}/faithful"), self.recruits(f"{prefix}/wa_faithful"),
+            RegionCounts(src["traitor_destinations"]), RegionCounts(src["uninterested_destinations"]), TimeRange.fromJSON(src["timeRange"]),
+            {k: Retention.fromJSON(v) for k, v in src["retention"].items()}, Cohorts.fromJSON(src["cohorts"]) if "cohorts" in src else Cohorts.empty(),
+            {k: Activity.fromJSON(v) for k, v in src.get("activity", {}).items()})
+
+    # Canonical names of the sender nations, resolved when the report was generated.
+    def canon_names(self) -> dict[str, str]:
+        return self.report.get("canon_names", {})
+
+    # Overall analytics, methods and nations.
+    def overall(self) -> tuple[Analytics, dict[str, Stats], dict[str, Stats]]:
+        return self.analytics(self.report["analytics"], "report"), stats_from(self.report["methods"]), stats_from(self.report["nations"])
+
+    # Load the telegrams of every category. Unless full is set, only what the HTML report shows is read: the recipients and recruits
+    # of each category and template are left out, and no nation is added to registry.
+    def telegrams(self, registry: NationRegistry, full: bool = False) -> dict[str, Telegram]:
+        telegrams = {}
+
+        for i, category in enumerate(self.categories):
+            prefix = f"telegrams/{i}"
+            src = self.json(prefix)
+
+            telegram = Telegram()
+            telegram.stats = Stats.fromJSON(src["stats"])
+            telegram.category = src["category"]
+
+            if full:
+                telegram.recipients = self.nation_ids(f"{prefix}/recipients", registry)
+                telegram.recruits = {recruit.name: recruit for recruit in self.recruits(f"{prefix}/recruits")}
+
+            telegram.templates = []
+            for template_src in src["templates"]:
+                template = TelegramTemplate()
+                template.tgid = template_src["tgid"]
+                template.type = template_src["type"]
+                template.nation = template_src["nation"]
+                template.category = template_src["category"]
+                template.timeRange = TimeRange.fromJSON(template_src["timeRange"])
+                template.stats = Stats.fromJSON(template_src["stats"])
+                telegram.templates.append(template)
+
+            if full:
+                recipients = self.nation_ids(f"{prefix}/templates/recipients", registry)
+                recruits = self.recruits(f"{prefix}/templates/recruits")
+
+                for template, (start, end), (recruits_start, recruits_end) in zip(telegram.templates, self.offsets(f"{prefix}/templates/recipients"), self.offsets(f"{prefix}/templates/recruits")):
+                    template.recipients = recipients[start:end]
+                    template.recruits = {recruit.name: recruit for recruit in recruits[recruits_start:recruits_end]}
+
+            telegram.methods = stats_from(src["methods"])
+            telegram.nations = stats_from(src["nations"])
+            telegram.timeRange = TimeRange.fromJSON(src["timeRange"])
+            telegram.analytics = self.analytics(src["analytics"], prefix)
+
+            telegrams[category] = telegram
+
+        return telegrams
+
+# Write a whole report at once, e.g. one converted from a JSON report.
+def write_report(path: str, registry: NationRegistry, telegrams: dict[str, Telegram], analytics: Analytics, methods: dict[str, Stats], nations: dict[str, Stats], canon_names: dict[str, str]):
+    with ReportWriter(path, registry) as writer:
+        for telegram in telegrams.values():
+            writer.write_telegram(telegram)
+        writer.close(analytics, methods, nations, {"canon_names": canon_names})
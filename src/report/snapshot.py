@@ -0,0 +1,159 @@
+import os, sys, json, mmap, sqlite3
+import numpy as np
+from typing import Iterable
+from .paths import DUMP_DATABASE
+
+SNAPSHOT_FILE = "nations.snap"
+
+SNAPSHOT_MAGIC = b"MLSNAP"
+
+# Bump this whenever the layout of the snapshot file changes, so that existing snapshots get rebuilt.
+SNAPSHOT_VERSION = 1
+
+# Every section of the snapshot starts at a multiple of this, so that it can be viewed in place as a NumPy array.
+SECTION_ALIGNMENT = 64
+
+# Pack a list of strings into one UTF-8 blob and an array of offsets into it (string i is blob[offsets[i]:offsets[i+1]]).
+def pack_strings(strings: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in encoded], out=offsets[1:])
+
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+# Write a columnar snapshot of the dump: a sorted fixed-width name index, canonical names, dictionary-encoded region IDs,
+# a packed WA bitmap and int64 lastlogin values. Rows are (canon_name, api_name, region, wa, lastlogin) tuples, like the nations table.
+def write_snapshot(nation_data: Iterable[tuple], path: str = SNAPSHOT_FILE) -> None:
+    rows = sorted(nation_data, key=lambda row: row[1].encode("utf-8"))
+
+    regions = sorted({row[2] for row in rows})
+    region_ids = {region: i for i, region in enumerate(regions)}
+
+    canon_blob, canon_offsets = pack_strings([row[0] for row in rows])
+    region_blob, region_offsets = pack_strings(regions)
+
+    sections = {
+        "names": np.array([row[1].encode("utf-8") for row in rows], dtype=np.bytes_) if rows else np.zeros(0, dtype="S1"),
+        "canon_blob": canon_blob,
+        "canon_offsets": canon_offsets,
+        "region_blob": region_blob,
+        "region_offsets": region_offsets,
+        "region_ids": np.array([region_ids[row[2]] for row in rows], dtype=np.uint32),
+        "wa": np.packbits(np.array([bool(row[3]) for row in rows], dtype=bool)),
+        "lastlogin": np.array([row[4] for row in rows], dtype=np.int64),
+    }
+
+    header = {"version": SNAPSHOT_VERSION, "byteorder": sys.byteorder, "count": len(rows), "sections": {}}
+
+    # Section offsets are relative to the end of the header, so that they don't depend on the header's own length.
+    offset = 0
+    for name, array in sections.items():
+        header["sections"][name] = {"offset": offset, "dtype": array.dtype.str, "count": len(array)}
+        offset += -(-array.nbytes // SECTION_ALIGNMENT) * SECTION_ALIGNMENT
+
+    header_data = json.dumps(header).encode("utf-8")
+    header_size = -(-(len(SNAPSHOT_MAGIC) + 4 + len(header_data)) // SECTION_ALIGNMENT) * SECTION_ALIGNMENT
+
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(len(header_data).to_bytes(4, "little"))
+        f.write(header_data)
+
+        for name, array in sections.items():
+            f.seek(header_size + header["sections"][name]["offset"])
+            f.write(array.tobytes())
+
+        f.truncate(header_size + offset)
+
+    os.replace(temporary_path, path)
+
+def write_snapshot_from_database(con: sqlite3.Connection, path: str = SNAPSHOT_FILE) -> None:
+    write_snapshot(con.execute("SELECT * FROM nations"), path)
+
+def snapshot_version(path: str) -> int:
+    with open(path, "rb") as f:
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            return 0
+        header_length = int.from_bytes(f.read(4), "little")
+        header = json.loads(f.read(header_length))
+
+    if header.get("byteorder") != sys.byteorder:
+        return 0
+    return header.get("version", 0)
+
+# A read-only, memory-mapped view of a snapshot written by write_snapshot. Opening it only parses the small header;
+# every column is a NumPy array backed directly by the mapped file, so pages are only read from disk when they are used.
+class NationSnapshot:
+    def __init__(self, path: str = SNAPSHOT_FILE):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.map[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a Moonlark nation snapshot")
+
+        header_start = len(SNAPSHOT_MAGIC) + 4
+        header_length = int.from_bytes(self.map[len(SNAPSHOT_MAGIC):header_start], "little")
+        header = json.loads(self.map[header_start:header_start + header_length])
+
+        if header["version"] != SNAPSHOT_VERSION or header["byteorder"] != sys.byteorder:
+            raise ValueError(f"{path} was created by an incompatible version of Moonlark")
+
+        header_size = -(-(header_start + header_length) // SECTION_ALIGNMENT) * SECTION_ALIGNMENT
+
+        self.count = header["count"]
+        columns = {}
+        for name, section in header["sections"].items():
+            columns[name] = np.frombuffer(self.map, dtype=np.dtype(section["dtype"]), count=section["count"], offset=header_size + section["offset"])
+
+        self.names = columns["names"]
+        self.canon_blob = columns["canon_blob"]
+        self.canon_offsets = columns["canon_offsets"]
+        self.region_ids = columns["region_ids"]
+        self.wa_bitmap = columns["wa"]
+        self.lastlogin = columns["lastlogin"]
+
+        self.regions = [columns["region_blob"][start:end].tobytes().decode("utf-8") for start, end in zip(columns["region_offsets"][:-1], columns["region_offsets"][1:])]
+        self.region_index = {region: i for i, region in enumerate(self.regions)}
+
+    def close(self):
+        # Drop every view into the map before closing it.
+        self.names = self.canon_blob = self.canon_offsets = self.region_ids = self.wa_bitmap = self.lastlogin = None
+        self.map.close()
+        self.file.close()
+
+    # Find the row of each of the given API names, or -1 for nations that are not in the snapshot.
+    def find(self, names: list[str]) -> np.ndarray:
+        if len(names) == 0 or self.count == 0:
+            return np.full(len(names), -1, dtype=np.int64)
+
+        width = self.names.dtype.itemsize
+        encoded = [name.encode("utf-8") for name in names]
+        queries = np.array(encoded, dtype=f"S{width}")
+        too_long = np.fromiter((len(name) > width for name in encoded), dtype=bool, count=len(encoded))
+
+        rows = np.searchsorted(self.names, queries)
+        clipped = np.minimum(rows, self.count - 1)
+        found = (rows < self.count) & (self.names[clipped] == queries) & ~too_long
+
+        return np.where(found, clipped, -1)
+
+    def canon_name(self, row: int) -> str:
+        return self.canon_blob[self.canon_offsets[row]:self.canon_offsets[row + 1]].tobytes().decode("utf-8")
+
+    def wa(self, rows: np.ndarray) -> np.ndarray:
+        return ((self.wa_bitmap[rows >> 3] >> (7 - (rows & 7))) & 1).astype(bool)
+
+# Open the snapshot, (re)building it from the dump database first if it is missing, outdated or older than nations.db.
+def load_snapshot(con: sqlite3.Connection, rebuild: bool = False, path: str = SNAPSHOT_FILE, database: str = DUMP_DATABASE) -> NationSnapshot:
+    if not rebuild:
+        if not os.path.exists(path) or snapshot_version(path) != SNAPSHOT_VERSION:
+            rebuild = True
+        elif os.path.exists(database) and os.path.getmtime(database) > os.path.getmtime(path):
+            rebuild = True
+
+    if rebuild:
+        print(f"Writing nation snapshot to {path}")
+        write_snapshot_from_database(con, path)
+
+    return NationSnapshot(path)
@@ -0,0 +1,291 @@
+from dataclasses import dataclass, asdict
+from typing import TYPE_CHECKING
+from .classes import Activity, Analytics, Cohorts, Recruit, Stats, Telegram, TelegramTemplate, TimeRange, Retention
+from .filters import renderDate, sortByHighest, sortStatsByHighest, methodName, displayNumberWithCommas
+from .cohorts import COHORT_BUCKETS
+
+# Only needed for type hints, so that rendering an existing report doesn't import the dump backends.
+if TYPE_CHECKING:
+    from .backend import DumpBackend
+
+# Plain, precomputed data for the HTML templates: everything the templates display (sorted lists, rates, formatted numbers,
+# canonical nation names) is computed once here, so that rendering does no work besides reading attributes.
+
+@dataclass
+class StatsView:
+    delivered: int
+    readCount: int
+    recruitCount: int
+    deliveredDisplay: str
+    readCountDisplay: str
+    recruitCountDisplay: str
+    readRate: str
+    recruitRate: str
+    readToRecruitRate: str
+
+@dataclass
+class TimeRangeView:
+    start: str
+    end: str
+
+@dataclass
+class RankedStatsView:
+    name: str
+    label: str
+    stats: StatsView
+
+@dataclass
+class RegionCountView:
+    region: str
+    count: int
+
+@dataclass
+class RetentionView:
+    days: int
+    retained: int
+    measured: int
+    retainedDisplay: str
+    measuredDisplay: str
+    retentionRate: str
+
+@dataclass
+class ActivityView:
+    days: int
+    faithfulDisplay: str
+    waFaithfulDisplay: str
+    preserveRate: str
+    waPreserveRate: str
+
+@dataclass
+class ChartSeriesView:
+    name: str
+    color: str
+    total: str
+    points: str
+
+@dataclass
+class ChartLabelView:
+    x: float
+    anchor: str
+    text: str
+
+# A line chart of counts per time bucket, drawn as inline SVG; points are already scaled to the chart's width and height.
+@dataclass
+class ChartView:
+    title: str
+    width: int
+    height: int
+    maxValue: str
+    labels: list[ChartLabelView]
+    series: list[ChartSeriesView]
+
+@dataclass
+class TemplateView:
+    tgid: int
+    type: str
+    nation: str
+    timeRange: TimeRangeView
+    stats: StatsView
+
+@dataclass
+class CategorySummaryView:
+    category: str
+    timeRange: TimeRangeView
+    stats: StatsView
+
+@dataclass
+class TelegramView:
+    category: str
+    timeRange: TimeRangeView
+    stats: StatsView
+    retention: list[RetentionView]
+    activity: list[ActivityView]
+    charts: list[ChartView]
+    methods: list[RankedStatsView]
+    nations: list[RankedStatsView]
+    templates: list[TemplateView]
+
+@dataclass
+class IndexView:
+    timeRange: TimeRangeView
+    stats: StatsView
+    faithfulCountDisplay: str
+    preserveRate: str
+    waFaithfulCountDisplay: str
+    waPreserveRate: str
+    categories: list[CategorySummaryView]
+    competitors: list[RegionCountView]
+    retention: list[RetentionView]
+    activity: list[ActivityView]
+    charts: list[ChartView]
+    methods: list[RankedStatsView]
+    topNations: list[RankedStatsView]
+
+@dataclass
+class RegionFaithfulView:
+    faithfulCountDisplay: str
+    preserveRate: str
+    waFaithfulCountDisplay: str
+    waPreserveRate: str
+
+@dataclass
+class RegionComparisonView:
+    region: str
+    link: str
+    faithful: RegionFaithfulView
+    competitors: list[RegionCountView]
+
+@dataclass
+class CategoryComparisonView:
+    category: str
+    stats: StatsView
+    regions: list[RegionFaithfulView]
+
+# Index of a report generated for several regions, comparing the region reports in its subfolders.
+@dataclass
+class ComparisonView:
+    timeRange: TimeRangeView
+    stats: StatsView
+    regions: list[RegionComparisonView]
+    categories: list[CategoryComparisonView]
+
+# A list of a category page that is too large to be inlined, written as pages of JSON shards next to it (see write_shards).
+@dataclass
+class ShardedListView:
+    name: str
+    title: str
+    total: int
+    pages: int
+    pageSize: int
+
+# Number of sender nations listed on the index page.
+TOP_NATIONS = 5
+
+# Number of regions recruits left for listed for each region on the comparison page.
+TOP_COMPETITORS = 3
+
+CHART_WIDTH, CHART_HEIGHT, CHART_PADDING = 800, 200, 10
+
+# Number of time labels under a chart.
+CHART_LABELS = 6
+
+# Colors of the series of a chart, in order.
+CHART_COLORS = ["#2563eb", "#16a34a", "#d97706", "#dc2626", "#7c3aed", "#0891b2", "#db2777"]
+
+# Number of destination regions charted; on the index page, the cohorts of every category can have different main destinations.
+CHART_DESTINATIONS = 5
+
+# Every sender nation mentioned anywhere in the report, in order of first appearance.
+def sender_nations(telegrams: dict[str, Telegram], nations: dict[str, Stats]) -> list[str]:
+    names = dict.fromkeys(nations)
+
+    for telegram in telegrams.values():
+        names.update(dict.fromkeys(telegram.nations))
+
+        for template in telegram.templates:
+            names[template.nation] = None
+
+    return list(names)
+
+# Resolve the canonical name of every sender nation with a single bulk lookup.
+def resolve_canon_names(backend: "DumpBackend", telegrams: dict[str, Telegram], nations: dict[str, Stats]) -> dict[str, str]:
+    return backend.canon_names(sender_nations(telegrams, nations))
+
+def stats_view(stats: Stats) -> StatsView:
+    return StatsView(stats.delivered, stats.readCount, stats.recruitCount,
+        displayNumberWithCommas(stats.delivered), displayNumberWithCommas(stats.readCount), displayNumberWithCommas(stats.recruitCount),
+        stats.readRate, stats.recruitRate, stats.readToRecruitRate)
+
+def time_range_view(time_range: TimeRange) -> TimeRangeView:
+    return TimeRangeView(renderDate(time_range.start), renderDate(time_range.end))
+
+def retention_views(retention: dict[str, Retention]) -> list[RetentionView]:
+    return [RetentionView(r.days, r.retained, r.measured, displayNumberWithCommas(r.retained), displayNumberWithCommas(r.measured), r.retentionRate) for r in retention.values()]
+
+def activity_views(activity: dict[str, Activity]) -> list[ActivityView]:
+    return [ActivityView(a.days, displayNumberWithCommas(a.faithful), displayNumberWithCommas(a.waFaithful), a.preserveRate, a.waPreserveRate)
+        for a in sorted(activity.values(), key=lambda a: a.days)]
+
+def method_views(methods: dict[str, Stats]) -> list[RankedStatsView]:
+    return [RankedStatsView(method, methodName(method), stats_view(stats)) for method, stats in sortStatsByHighest(methods)]
+
+# Nations whose canonical name is unknown (e.g. because they ceased to exist) are shown under their API name.
+def nation_views(nations: dict[str, Stats], canon_names: dict[str, str], limit: int | None = None) -> list[RankedStatsView]:
+    return [RankedStatsView(nation, canon_names.get(nation, nation), stats_view(stats)) for nation, stats in sortStatsByHighest(nations)[:limit]]
+
+def chart_view(title: str, cohorts: Cohorts, series: list[tuple[str, list[int]]]) -> ChartView:
+    count = cohorts.bucketCount
+    highest = max((max(values) for _, values in series), default=0)
+
+    step = (CHART_WIDTH - 2 * CHART_PADDING) / max(count - 1, 1)
+    scale = (CHART_HEIGHT - 2 * CHART_PADDING) / max(highest, 1)
+
+    def points(values: list[int]) -> str:
+        return " ".join(f"{CHART_PADDING + i * step:.1f},{CHART_HEIGHT - CHART_PADDING - value * scale:.1f}" for i, value in enumerate(values))
+
+    # The first and last labels are aligned to the edges of the chart, so that they aren't cut off.
+    indexes = sorted({round(n * (count - 1) / max(CHART_LABELS - 1, 1)) for n in range(CHART_LABELS)})
+    labels = [ChartLabelView(round(CHART_PADDING + i * step, 1), "start" if i == 0 else "end" if i == count - 1 else "middle",
+        renderDate(cohorts.start + i * cohorts.bucket)) for i in indexes]
+
+    return ChartView(title, CHART_WIDTH, CHART_HEIGHT, displayNumberWithCommas(highest), labels,
+        [ChartSeriesView(name, CHART_COLORS[i % len(CHART_COLORS)], displayNumberWithCommas(sum(values)), points(values)) for i, (name, values) in enumerate(series)])
+
+# Charts of recruitment over time, and of where recruits went over time. No charts are drawn for reports generated without cohorts.
+def cohort_charts(cohorts: Cohorts) -> list[ChartView]:
+    if cohorts.bucketCount == 0:
+        return []
+
+    period = "Week" if cohorts.bucket == COHORT_BUCKETS["week"] else "Day"
+    charts = [chart_view(f"Recruits per {period}", cohorts, [("Recruits", cohorts.recruits), ("Faithful", cohorts.faithful), ("WA Faithful", cohorts.waFaithful)])]
+
+    destinations = sorted(cohorts.destinations.items(), key=lambda item: sum(item[1]), reverse=True)[:CHART_DESTINATIONS]
+    if destinations:
+        charts.append(chart_view(f"Regions Recruits Left For, per {period}", cohorts, destinations))
+
+    return charts
+
+def template_view(template: TelegramTemplate) -> TemplateView:
+    return TemplateView(template.tgid, template.type, template.nation, time_range_view(template.timeRange), stats_view(template.stats))
+
+def build_telegram_view(telegram: Telegram, canon_names: dict[str, str]) -> TelegramView:
+    return TelegramView(telegram.category, time_range_view(telegram.timeRange), stats_view(telegram.stats), retention_views(telegram.analytics.retention),
+        activity_views(telegram.analytics.activity), cohort_charts(telegram.analytics.cohorts), method_views(telegram.methods), nation_views(telegram.nations, canon_names),
+        [template_view(template) for template in telegram.templates])
+
+def recruit_rows(faithful: list[Recruit], wa_faithful: list[Recruit]) -> list[dict]:
+    wa = {recruit.name for recruit in wa_faithful}
+    return [{"name": recruit.name, "recruitedAt": renderDate(recruit.recruitedAt), "wa": recruit.name in wa} for recruit in faithful]
+
+# Rows of the lists of a category page that are loaded on demand in sharded output, by list name, with their titles.
+# Faithful recruits and the regions that recruits left for are only shown in sharded output, since they can be too large to inline.
+def build_telegram_shards(telegram: Telegram, canon_names: dict[str, str]) -> dict[str, tuple[str, list[dict]]]:
+    analytics = telegram.analytics
+    return {
+        "nations": ("Telegram Breakdown (by Nation)", [asdict(view) for view in nation_views(telegram.nations, canon_names)]),
+        "templates": ("Telegram Breakdown (by Template)", [asdict(template_view(template)) for template in telegram.templates]),
+        "faithful": ("Faithful Recruits", recruit_rows(analytics.faithful, analytics.wa_faithful)),
+        "destinations": ("Regions Recruits Left For", [asdict(RegionCountView(region, count)) for region, count in sortByHighest(analytics.traitor_destinations)]),
+    }
+
+def build_index_view(analytics: Analytics, methods: dict[str, Stats], nations: dict[str, Stats], telegrams: dict[str, Telegram], canon_names: dict[str, str]) -> IndexView:
+    categories = [CategorySummaryView(category, time_range_view(telegram.timeRange), stats_view(telegram.stats)) for category, telegram in telegrams.items()]
+    competitors = [RegionCountView(region, count) for region, count in sortByHighest(analytics.traitor_destinations)]
+
+    return IndexView(time_range_view(analytics.timeRange), stats_view(analytics.stats),
+        displayNumberWithCommas(analytics.faithfulCount), analytics.preserveRate, displayNumberWithCommas(analytics.waFaithfulCount), analytics.waPreserveRate,
+        categories, competitors, retention_views(analytics.retention), activity_views(analytics.activity), cohort_charts(analytics.cohorts),
+        method_views(methods), nation_views(nations, canon_names, TOP_NATIONS))
+
+def region_faithful_view(analytics: Analytics) -> RegionFaithfulView:
+    return RegionFaithfulView(displayNumberWithCommas(analytics.faithfulCount), analytics.preserveRate, displayNumberWithCommas(analytics.waFaithfulCount), analytics.waPreserveRate)
+
+# Regions are in the order they were requested in, and their reports in subfolders named after them.
+def build_comparison_view(regions: list[str], analytics: list[Analytics], telegrams: dict[str, Telegram], category_analytics: list[dict[str, Analytics]]) -> ComparisonView:
+    region_views = [RegionComparisonView(region, f"{region}/index.html", region_faithful_view(overall),
+        [RegionCountView(competitor, count) for competitor, count in sortByHighest(overall.traitor_destinations)[:TOP_COMPETITORS]]) for region, overall in zip(regions, analytics)]
+
+    categories = [CategoryComparisonView(category, stats_view(telegram.stats), [region_faithful_view(by_category[category]) for by_category in category_analytics])
+        for category, telegram in telegrams.items()]
+
+    return ComparisonView(time_range_view(analytics[0].timeRange), stats_view(analytics[0].stats), region_views, categories)